@@ -1,11 +1,29 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from assets import Assets, build_assets
+from compression import CompressionMiddleware
+from directory import UserDirectory, cursor_from_request as directory_cursor
+from feed import feed_items, profile_feed_query, likes_feed_query
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from fragments import FragmentCache
+from httpcache import (cache_policy, apply_cache_policy, conditional,
+                       profile_etag, message_etag)
+from loader import load_csvs
+from migrations import migrate, check_query_plans
+from models import db, connect_db, User, Message, Likes, Follows
+from pagination import cursor_from_request, paginate_messages
+from passwords import password_pool, PasswordPoolBusy
+from principal import PrincipalCache
+from ratelimit import RateLimiter, create_backend
+from timeline import (create_timeline_store, home_timeline, fan_out, retract,
+                      follower_ids)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,10 +38,120 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['TIMELINE_STORE'] = os.environ.get('TIMELINE_STORE', 'memory://')
+# For the in-process store: how long a worker's timelines live (seconds),
+# and how many users' it keeps. Use a shared store (sqlite:///...) to have
+# every worker see new posts straight away.
+app.config['TIMELINE_TTL'] = int(os.environ.get('TIMELINE_TTL', 60))
+app.config['TIMELINE_MAX_USERS'] = int(
+    os.environ.get('TIMELINE_MAX_USERS', 10000))
+app.config['FEED_PULL_THRESHOLD'] = int(
+    os.environ.get('FEED_PULL_THRESHOLD', 10000))
+app.config['PRINCIPAL_TTL'] = int(os.environ.get('PRINCIPAL_TTL', 30))
+app.config['FRAGMENT_CACHE_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+app.config['ASSETS_DIR'] = os.environ.get(
+    'ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+app.config['COMPRESS_MIN_SIZE'] = int(
+    os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2))
+app.config['PASSWORD_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_MAX_PENDING', 8))
+
+# Limits on login/signup attempts, as "attempts/seconds"
+app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND',
+                                                 'memory://')
+app.config['LOGIN_LIMIT_PER_IP'] = os.environ.get('LOGIN_LIMIT_PER_IP', '20/60')
+app.config['LOGIN_LIMIT_PER_USERNAME'] = os.environ.get(
+    'LOGIN_LIMIT_PER_USERNAME', '5/60')
+app.config['SIGNUP_LIMIT_PER_IP'] = os.environ.get('SIGNUP_LIMIT_PER_IP',
+                                                   '5/60')
+# /users/available is called as the signup form is typed in, so it gets
+# more room than signup itself, but it still can't be used to sweep names
+app.config['AVAILABLE_LIMIT_PER_IP'] = os.environ.get(
+    'AVAILABLE_LIMIT_PER_IP', '30/60')
+# How many proxies in front of the app set X-Forwarded-For/-Proto. The rate
+# limits and the /_metrics check go by the client address these resolve
+# to; without it every request would seem to come from the proxy. Set it
+# to 0 when the app is reached directly, or clients could pick their own
+# address.
+app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', 1))
+# How stale (seconds) this worker's typeahead index may get
+app.config['TYPEAHEAD_MAX_AGE'] = int(os.environ.get('TYPEAHEAD_MAX_AGE', 60))
+# How stale (seconds) this worker's filter of taken names may get
+app.config['TAKEN_NAMES_MAX_AGE'] = int(
+    os.environ.get('TAKEN_NAMES_MAX_AGE', 60))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+# bcrypt runs on its own bounded thread pool, see passwords.py
+password_pool.configure(workers=app.config['PASSWORD_WORKERS'],
+                        max_pending=app.config['PASSWORD_MAX_PENDING'],
+                        rounds=app.config['BCRYPT_LOG_ROUNDS'])
+
+# Admission control for login/signup, see ratelimit.py
+ratelimit_backend = create_backend(app.config['RATELIMIT_BACKEND'])
+limits = {
+    'login-ip': RateLimiter(ratelimit_backend, 'login-ip',
+                            app.config['LOGIN_LIMIT_PER_IP']),
+    'login-username': RateLimiter(ratelimit_backend, 'login-username',
+                                  app.config['LOGIN_LIMIT_PER_USERNAME']),
+    'signup-ip': RateLimiter(ratelimit_backend, 'signup-ip',
+                             app.config['SIGNUP_LIMIT_PER_IP']),
+    'available-ip': RateLimiter(ratelimit_backend, 'available-ip',
+                                app.config['AVAILABLE_LIMIT_PER_IP']),
+}
+
+# Precomputed home feeds, see timeline.py
+timelines = create_timeline_store(app.config['TIMELINE_STORE'],
+                                  ttl=app.config['TIMELINE_TTL'],
+                                  max_users=app.config['TIMELINE_MAX_USERS'])
+
+# Cached snapshots of logged-in users, see principal.py
+principals = PrincipalCache(ttl=app.config['PRINCIPAL_TTL'])
+
+# Browsing and searching users, see directory.py
+directory = UserDirectory(prefix_max_age=app.config['TYPEAHEAD_MAX_AGE'],
+                          taken_max_age=app.config['TAKEN_NAMES_MAX_AGE'])
+
+# Rendered message cards, see fragments.py
+fragments = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+# gzip for HTML and JSON responses, see compression.py
+compressor = app.wsgi_app = CompressionMiddleware(
+    app.wsgi_app, min_size=app.config['COMPRESS_MIN_SIZE'],
+    level=app.config['COMPRESS_LEVEL'])
+
+# Client address and scheme from the hosting proxy's headers, so
+# request.remote_addr is the client's, not the proxy's
+if app.config['PROXY_FIX_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'],
+                            x_proto=app.config['PROXY_FIX_HOPS'])
+
+# Fingerprinted static files, see assets.py
+assets = Assets()
+assets.load(app.config['ASSETS_DIR'])
+
+
+@app.template_global()
+def asset_url(name):
+    """URL for static/<name>, fingerprinted once `flask build-assets` ran."""
+
+    return assets.url(name)
+
+
+@app.template_global()
+def message_card(msg):
+    """The viewer-independent body of a message card (a FeedItem)."""
+
+    return fragments.render(
+        msg.id, msg.author_version,
+        lambda: app.jinja_env.get_template('messages/card.html').render(
+            msg=msg))
+
 
 ##############################################################################
 # User signup/login/logout
@@ -31,21 +159,65 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a cached Principal (see principal.py), not a User row; routes
+    that need to change the user load the row with current_user().
+    """
+
+    # connect_db pushes one app context for the whole process, so g outlives
+    # the request: drop the last request's row, or the next user (whoever
+    # they are) would act on it
+    g.pop('user_row', None)
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = principals.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def current_user():
+    """The logged-in User row (loaded at most once per request)."""
+
+    if 'user_row' not in g:
+        g.user_row = db.session.get(User, g.user.id)
+    return g.user_row
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
 
 
+def over_limit(*checks):
+    """Check (limit name, key) pairs; True if any of them is over its limit.
+
+    Every check takes a token, so guessing many passwords for one account
+    from many addresses is limited as well as one address trying many
+    accounts.
+    """
+
+    results = [limits[name].allow(key) for name, key in checks]
+    return not all(results)
+
+
+def too_many_attempts(template, form):
+    """Turn away a login/signup attempt that's over its rate limit."""
+
+    flash("Too many attempts. Please wait a minute and try again.", 'danger')
+    return render_template(template, form=form), 429
+
+
+def try_again_later(template, form):
+    """Re-show a form when the password pool is saturated."""
+
+    flash("We're very busy right now, please try again in a moment.",
+          'warning')
+    return render_template(template, form=form), 503
+
+
 def do_logout():
     """Logout user."""
 
@@ -70,7 +242,23 @@ def signup():
 
     form = UserAddForm()
 
+    if request.method == 'POST' and over_limit(
+            ('signup-ip', request.remote_addr)):
+        return too_many_attempts('users/signup.html', form)
+
     if form.validate_on_submit():
+        # catch taken names before spending a bcrypt hash on the password;
+        # confirmed with a query, as other workers may have added them
+        taken = False
+        if directory.username_taken(form.username.data, confirm=True):
+            form.username.errors.append("Username already taken")
+            taken = True
+        if directory.email_taken(form.email.data, confirm=True):
+            form.email.errors.append("E-mail already taken")
+            taken = True
+        if taken:
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -79,11 +267,16 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            directory.put(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordPoolBusy:
+            db.session.rollback()
+            return try_again_later('users/signup.html', form)
+
         do_login(user)
 
         return redirect("/")
@@ -98,11 +291,22 @@ def login():
 
     form = LoginForm()
 
+    # checked before the form, so rejected attempts never reach bcrypt
+    if request.method == 'POST' and over_limit(
+            ('login-ip', request.remote_addr),
+            ('login-username', request.form.get('username', '').lower())):
+        return too_many_attempts('users/login.html', form)
+
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordPoolBusy:
+            return try_again_later('users/login.html', form)
 
         if user:
+            # saves the password if authenticate() rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -133,31 +337,76 @@ def list_users():
     """
 
     search = request.args.get('q')
+    page = directory.page(search, directory_cursor(), 100)
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    # one query for the follow buttons on every card
+    following_ids = (g.user.following_ids(user.id for user in page.items)
+                     if g.user else set())
+
+    return render_template('users/index.html', users=page.items,
+                           following_ids=following_ids, search=search,
+                           next_cursor=page.next_cursor)
+
+
+@app.route('/users/available')
+def users_available():
+    """Are ?username= and/or ?email= free to sign up with? As JSON.
+
+    Mostly answered without a query (see TakenNames in directory.py), so
+    it's cheap enough to call as the signup form is filled in. Rate limited
+    per address, so it can't be used to list who has an account.
+    """
+
+    if over_limit(('available-ip', request.remote_addr)):
+        return jsonify(error="Too many requests"), 429
+
+    available = {}
+    if request.args.get('username'):
+        available['username'] = not directory.username_taken(
+            request.args['username'])
+    if request.args.get('email'):
+        available['email'] = not directory.email_taken(request.args['email'])
+
+    return jsonify(available)
+
+
+@app.route('/users/typeahead')
+def users_typeahead():
+    """Users whose name starts with ?q=, as JSON, for as-you-type search.
+
+    Answered from an in-memory index (see directory.py); ?limit= is at
+    most 20.
+    """
 
-    return render_template('users/index.html', users=users)
+    limit = min(request.args.get('limit', 10, type=int), 20)
+    users = directory.typeahead(request.args.get('q', ''), max(limit, 0))
+
+    return jsonify(users=[{'id': user_id, 'username': username}
+                          for user_id, username in users])
 
 
 @app.route('/users/<int:user_id>')
+@cache_policy('no-cache')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    etag = profile_etag(user_id)
+    if etag is None:
+        abort(404)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    return render_template('users/show.html', user=user, messages=messages)
+    def render():
+        user = User.query.get_or_404(user_id)
+
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        page = paginate_messages(profile_feed_query(user_id),
+                                 cursor_from_request(), 100, feed_items)
+
+        return render_template('users/show.html', user=user,
+                               messages=page.items,
+                               next_cursor=page.next_cursor)
+
+    return conditional(etag, render)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -169,7 +418,9 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following_ids = g.user.following_ids(u.id for u in user.following)
+    return render_template('users/following.html', user=user,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -181,7 +432,9 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    following_ids = g.user.following_ids(u.id for u in user.followers)
+    return render_template('users/followers.html', user=user,
+                           following_ids=following_ids)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -193,8 +446,10 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    current_user().follow(followed_user)
     db.session.commit()
+    timelines.drop([g.user.id])
+    principals.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -207,9 +462,11 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    current_user().unfollow(followed_user)
     db.session.commit()
+    timelines.drop([g.user.id])
+    principals.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -222,10 +479,16 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = g.user
+    user = current_user()
     form = UserEditForm(obj = user)
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        try:
+            authenticated = User.authenticate(user.username,
+                                              form.password.data)
+        except PasswordPoolBusy:
+            return try_again_later('/users/edit.html', form)
+
+        if authenticated:
             username = form.username.data
             email= form.email.data
             image_url = form.image_url.data
@@ -237,7 +500,10 @@ def profile():
             user.image_url = image_url
             user.header_image_url = header_image_url
             user.bio = bio
+            user.version = User.version + 1
             db.session.commit()
+            principals.invalidate(user.id)
+            directory.put(user)
             return redirect(f'/users/{user.id}')
         else:
             flash("Your password is incorrect!", 'danger')
@@ -256,8 +522,32 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # their messages are in their followers' feeds; rebuild those
+    followers = follower_ids(g.user.id)
+    timelines.drop(followers + [g.user.id])
+
+    # everyone whose counters will change once this user is gone
+    affected = set(followers)
+    affected.update(
+        user_id for (user_id,) in
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == g.user.id))
+    affected.update(
+        user_id for (user_id,) in
+        db.session.query(Likes.user_id).join(Message)
+        .filter(Message.user_id == g.user.id))
+    affected.discard(g.user.id)
+    liked = [message_id for (message_id,) in
+             db.session.query(Likes.message_id).filter_by(user_id=g.user.id)]
+
+    db.session.delete(current_user())
+    db.session.commit()
+
+    User.reconcile_counters(affected)
+    Message.reconcile_counters(liked)
     db.session.commit()
+    principals.invalidate(g.user.id, *affected)
+    directory.remove(g.user.id)
 
     return redirect("/signup")
 
@@ -269,14 +559,10 @@ def like_a_message(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    liked_message = Likes.query.filter_by(message_id = msg_id).first()
-    if not liked_message:
-        new_like = Likes(user_id = g.user.id, message_id = msg_id)
-        db.session.add(new_like)
-        db.session.commit()
-    else:
-        db.session.delete(liked_message)
-        db.session.commit()
+    Message.query.get_or_404(msg_id)
+    Likes.toggle(g.user.id, msg_id)
+    db.session.commit()
+    principals.invalidate(g.user.id)
     return redirect('/')
 
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
@@ -288,9 +574,14 @@ def show_all_liked_messages_page(user_id):
 
     user = User.query.get_or_404(user_id)    
 
-    liked_messages = Likes.query.filter_by(user_id = user_id).all()
-    likes = [each_msg.message_id for each_msg in liked_messages]
-    return render_template('/users/likes.html', user = user, messages=user.likes, likes=likes)
+    page = paginate_messages(likes_feed_query(user_id),
+                             cursor_from_request(), 100, feed_items)
+    # like buttons are for the viewer, who may not be the profile owner
+    likes, like_counts = Likes.state_for(g.user.id,
+                                         (msg.id for msg in page.items))
+    return render_template('/users/likes.html', user = user, messages=page.items,
+                           likes=likes, like_counts=like_counts,
+                           next_cursor=page.next_cursor)
 ##############################################################################
 # Messages routes:
 
@@ -311,9 +602,11 @@ def messages_add():
         if session.get(CURR_USER_KEY) != g.user.id:
             flash("Access unauthorized.", "danger")
             return redirect("/")
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
         db.session.commit()
+        principals.invalidate(g.user.id)
+        fan_out(timelines, msg, app.config['FEED_PULL_THRESHOLD'])
 
         return redirect(f"/users/{g.user.id}")
 
@@ -321,11 +614,20 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cache_policy('no-cache')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    etag = message_etag(message_id)
+    if etag is None:
+        abort(404)
+
+    def render():
+        msg = (Message.query.options(db.joinedload(Message.user))
+               .get_or_404(message_id))
+        return render_template('messages/show.html', message=msg)
+
+    return conditional(etag, render)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -340,8 +642,13 @@ def messages_destroy(message_id):
     if msg.user_id != g.user.id:
             flash("Access unauthorized.", "danger")
             return redirect("/")
+    retract(timelines, msg)
+    likers = [user_id for (user_id,) in
+              db.session.query(Likes.user_id).filter_by(message_id=msg.id)]
     db.session.delete(msg)
     db.session.commit()
+    principals.invalidate(msg.user_id, *likers)
+    fragments.evict(msg.id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -355,36 +662,133 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      ?before=<cursor> link to the next 100
     """
 
     if g.user:
 
-        list_of_followings = g.user.following
-        messages_from_followings = Message.query.filter(Message.user_id.in_([each.id for each in list_of_followings]+ [g.user.id])).order_by(Message.timestamp.desc()).limit(100).all()
+        page = home_timeline(timelines, g.user.id, 100,
+                             app.config['FEED_PULL_THRESHOLD'],
+                             before=cursor_from_request())
 
-        liked_messages = Likes.query.filter_by(user_id = g.user.id).all()
-        likes = [each_msg.message_id for each_msg in liked_messages]
+        likes, like_counts = Likes.state_for(g.user.id,
+                                             (msg.id for msg in page.items))
 
-        return render_template('home.html', messages=messages_from_followings, likes=likes)
+        return render_template('home.html', messages=page.items, likes=likes,
+                               like_counts=like_counts,
+                               next_cursor=page.next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Static assets
+
+
+@app.route('/assets/<path:filename>')
+def fingerprinted_asset(filename):
+    """Serve a fingerprinted static file; these never change."""
+
+    return assets.send(filename)
+
+
+##############################################################################
+# Metrics
+
+
+@app.route('/_metrics')
+def metrics():
+    """Internal counters for this worker, as JSON (local requests only).
+
+    Local by the client address ProxyFix resolved, so requests relayed by
+    the hosting proxy are turned away too.
+    """
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return jsonify(passwords=password_pool.stats(),
+                   fragments=fragments.stats(),
+                   compression=compressor.stats(),
+                   taken_names=directory.taken.stats())
+
+
+##############################################################################
+# Database maintenance commands
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Add any missing tables and indexes to the database."""
+
+    created = migrate()
+    for name in created:
+        click.echo(f"Created {name}")
+    if not created:
+        click.echo("Database is up to date.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint static files into ASSETS_DIR and write the manifest."""
+
+    manifest = build_assets(app.static_folder, app.config['ASSETS_DIR'])
+    assets.load(app.config['ASSETS_DIR'])
+    click.echo(f"Built {len(manifest)} assets into {app.config['ASSETS_DIR']}")
+
+
+@app.cli.command('load-csvs')
+@click.argument('directory', default='generator')
+@click.option('--chunk-rows', default=50000,
+              help='Rows per COPY/INSERT batch (and per commit).')
+@click.option('--workers', default=4,
+              help='Shards of a table to load at once (Postgres only).')
+def load_csvs_command(directory, chunk_rows, workers):
+    """Recreate the database from the CSVs (or manifest.json) in DIRECTORY."""
+
+    loaded = load_csvs(directory, chunk_rows=chunk_rows, workers=workers,
+                       echo=click.echo)
+    rows = sum(count for count, _ in loaded.values())
+    seconds = sum(elapsed for _, elapsed in loaded.values())
+    click.echo(f"Loaded {rows} rows "
+               f"({rows / seconds if seconds else 0:,.0f} rows/s).")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Rebuild every user's and message's counters from scratch."""
+
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+    click.echo("Counters rebuilt.")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any feed route's main query scans the messages table."""
+
+    problems = check_query_plans()
+    for name, plan in problems.items():
+        click.echo(f"{name}:", err=True)
+        for line in plan:
+            click.echo(f"    {line}", err=True)
+    if problems:
+        raise click.ClickException(
+            f"{len(problems)} queries scan the messages table")
+    click.echo("All feed queries use an index.")
+
+
+##############################################################################
+# Caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Views are no-store unless they say otherwise with @cache_policy; see
+# httpcache.py. Profile and message pages are revalidated with ETags.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add the view's Cache-Control header."""
+
+    return apply_cache_policy(response)
@@ -0,0 +1,156 @@
+"""Fingerprinted static files.
+
+`flask build-assets` copies every file under static/ into static/dist/
+under a name that includes a hash of its contents (style.css becomes
+style.1a2b3c4d5e6f.css), and writes a manifest.json mapping one to the
+other. Stylesheets are built last, with their url(/static/...) references
+pointing at the fingerprinted images.
+
+Templates link to files with asset_url("stylesheets/style.css"). Once the
+manifest exists that's /assets/<fingerprinted name>, which never changes
+content and so is served with a one-year, immutable Cache-Control. Without
+a manifest (e.g. in development) it's the plain /static/ URL.
+
+Compressible files also get .gz (and, if the brotli package is installed,
+.br) variants at build time; we serve whichever the client accepts.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import abort, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = "manifest.json"
+URL_PREFIX = "/assets/"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".ico", ".json", ".txt"}
+
+# (Accept-Encoding name, file suffix), most preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+CSS_URL = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+
+def fingerprint(name, content):
+    """style.css -> style.<hash of content>.css"""
+
+    base, ext = os.path.splitext(name)
+    return f"{base}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def compress(path, content):
+    """Write .gz/.br variants of a file, where they're smaller."""
+
+    variants = {".gz": gzip.compress(content, 9, mtime=0)}
+    if brotli:
+        variants[".br"] = brotli.compress(content)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(content):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+
+
+def build_assets(static_dir, out_dir):
+    """Fingerprint every file in static_dir into out_dir; return the
+    manifest ({name: fingerprinted name})."""
+
+    out_dir = os.path.abspath(out_dir)
+    names = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.abspath(os.path.join(root, d)) != out_dir]
+        for filename in files:
+            path = os.path.join(root, filename)
+            names.append(os.path.relpath(path, static_dir).replace(os.sep, "/"))
+
+    def rewrite(match):
+        quote, name = match.groups()
+        if name not in manifest:
+            return match.group(0)
+        return f"url({quote}{URL_PREFIX}{manifest[name]}{quote})"
+
+    manifest = {}
+    for name in sorted(names, key=lambda name: (name.endswith(".css"), name)):
+        with open(os.path.join(static_dir, name), "rb") as f:
+            content = f.read()
+        if name.endswith(".css"):
+            content = CSS_URL.sub(rewrite, content.decode()).encode()
+
+        hashed = fingerprint(name, content)
+        path = os.path.join(out_dir, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            compress(path, content)
+
+        manifest[name] = hashed
+
+    with open(os.path.join(out_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """The built manifest, and serving the files it names."""
+
+    def __init__(self):
+        self.out_dir = None
+        self.manifest = {}
+        self._files = set()
+
+    def load(self, out_dir):
+        """Read out_dir's manifest; with none, URLs point at /static/."""
+
+        self.out_dir = out_dir
+        try:
+            with open(os.path.join(out_dir, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        self._files = set(self.manifest.values())
+
+    def url(self, name):
+        """URL for the file static/<name>."""
+
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return f"/static/{name}"
+        return URL_PREFIX + hashed
+
+    def send(self, filename):
+        """Response for /assets/<filename>, precompressed if we can."""
+
+        if filename not in self._files:
+            abort(404)
+
+        served, encoding = filename, None
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            for name, suffix in ENCODINGS:
+                if (request.accept_encodings[name] and os.path.exists(
+                        os.path.join(self.out_dir, filename + suffix))):
+                    served, encoding = filename + suffix, name
+                    break
+
+        response = send_from_directory(
+            self.out_dir, served,
+            mimetype=mimetypes.guess_type(filename)[0],
+            max_age=31536000)
+        response.headers["Cache-Control"] = IMMUTABLE
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            response.vary.add("Accept-Encoding")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response
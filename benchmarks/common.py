@@ -0,0 +1,119 @@
+"""Shared pieces of the benchmarks: seeding a dataset, summarizing timings
+and writing results.
+
+Results files are JSON:
+
+    {"benchmark": "http", "commit": "...", "created": "...",
+     "database": "postgresql", "dataset": {"users": 300, ...},
+     "params": {...}, "results": {name: {"p50_ms": ..., ...}, ...}}
+
+so two runs (say, on two commits) can be compared name by name with
+compare().
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from loader import load_csvs
+from models import db, User, Message, Follows, Likes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed_database(scale, seed=1, echo=print):
+    """Replace the database's contents with a generated dataset."""
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([sys.executable,
+                        os.path.join(ROOT, "generator", "create_csvs.py"),
+                        "--scale", str(scale), "--seed", str(seed),
+                        "--out", out],
+                       check=True, stdout=subprocess.DEVNULL)
+        load_csvs(out, echo=echo)
+
+
+def dataset_size():
+    """Row counts of the main tables."""
+
+    return {model.__tablename__: db.session.query(model).count()
+            for model in (User, Message, Follows, Likes)}
+
+
+def percentile(ordered, p):
+    """The p-th percentile (0-100) of sorted values, by linear
+    interpolation."""
+
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(seconds):
+    """Latency summary, in milliseconds, of a list of timings in seconds."""
+
+    ordered = sorted(seconds)
+    ms = [value * 1000 for value in ordered]
+    return {
+        "count": len(ms),
+        "mean_ms": sum(ms) / len(ms) if ms else None,
+        "min_ms": ms[0] if ms else None,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": ms[-1] if ms else None,
+    }
+
+
+def current_commit():
+    """The checked-out commit, or None outside a git checkout."""
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                              check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, benchmark, params, results, dataset=None):
+    """Write a results file; returns what was written."""
+
+    report = {
+        "benchmark": benchmark,
+        "commit": current_commit(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "database": db.engine.dialect.name,
+        "dataset": dataset,
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def compare(old, new, threshold, metric="p50_ms"):
+    """[(name, old value, new value, relative change, verdict)] for the
+    results in both reports; the verdict is "slower", "faster" or ""
+    (within the threshold)."""
+
+    rows = []
+    for name, result in new["results"].items():
+        before = old["results"].get(name, {}).get(metric)
+        after = result.get(metric)
+        if not before or after is None:
+            continue
+        change = after / before - 1
+        verdict = ("" if abs(change) <= threshold
+                   else "slower" if change > 0 else "faster")
+        rows.append((name, before, after, change, verdict))
+    return rows
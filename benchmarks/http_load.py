@@ -0,0 +1,223 @@
+"""Load test: drive a mix of Warbler requests through the WSGI app.
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python -m benchmarks.http_load --scale 10 --requests 5000
+
+Seeds the database with a generated dataset (`--scale` as in
+generator/create_csvs.py; this REPLACES whatever is in it, so point
+DATABASE_URL at a scratch database), logs in `--users` virtual users, then
+sends `--requests` requests picked from WORKLOAD, each from a random
+virtual user. Everything runs in this process, one request at a time,
+through the full middleware stack (gzip included), so requests per second
+is the throughput of a single worker.
+
+For each route, and for all requests together, it reports p50/p95/p99
+latency, requests per second (for a route, how many of just that request
+one worker could serve), queries per request and the status codes seen,
+and writes them to benchmarks/results/http-<commit>.json (or `--out`).
+The first `--warmup` requests fill the caches and aren't counted.
+
+Logins check real bcrypt hashes (every generated user's password is
+"password"), so they're slow on purpose. The login rate limits are raised
+for the run, since the virtual users log in far more often than people do.
+"""
+
+import argparse
+import os
+import random
+import time
+from collections import Counter
+
+os.environ.setdefault("DATABASE_URL", "postgresql:///warbler-bench")
+for limit in ("LOGIN_LIMIT_PER_IP", "LOGIN_LIMIT_PER_USERNAME"):
+    os.environ.setdefault(limit, "1000000/60")
+
+from app import app
+from benchmarks.common import (ROOT, current_commit, dataset_size,
+                               seed_database, summarize, write_results)
+from models import db, User, Message
+from querycount import count_queries
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# (route, relative weight)
+WORKLOAD = [
+    ("home", 35),
+    ("profile", 25),
+    ("directory", 15),
+    ("like", 12),
+    ("new_message", 8),
+    ("login", 5),
+]
+
+
+class VirtualUser:
+    """A logged-in client with its own cookies and address."""
+
+    def __init__(self, number, user_id, username):
+        self.user_id = user_id
+        self.username = username
+        self.client = app.test_client()
+        self.client.environ_base.update(
+            REMOTE_ADDR=f"10.0.{number // 256}.{number % 256}",
+            HTTP_ACCEPT_ENCODING="gzip")
+
+    def login(self):
+        return self.client.post("/login", data={"username": self.username,
+                                                "password": "password"})
+
+
+class Workload:
+    """Turns route names into requests against the seeded data."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.user_ids = [id for (id,) in db.session.query(User.id)]
+        self.usernames = [name for (name,) in db.session.query(User.username)]
+        self.message_ids = [id for (id,) in db.session.query(Message.id)]
+
+    def request(self, route, user):
+        """(method, path, form data) for one request to `route`."""
+
+        rng = self.rng
+        if route == "home":
+            return "GET", "/", None
+        if route == "profile":
+            return "GET", f"/users/{rng.choice(self.user_ids)}", None
+        if route == "directory":
+            if rng.random() < 0.5:
+                return "GET", "/users", None
+            # search for part of a real name, as someone would type it
+            name = rng.choice(self.usernames)
+            return "GET", f"/users?q={name[:rng.randint(2, 4)]}", None
+        if route == "like":
+            return ("POST", f"/users/add_like/{rng.choice(self.message_ids)}",
+                    None)
+        if route == "new_message":
+            return "POST", "/messages/new", {
+                "text": f"Benchmark warble {rng.randrange(10 ** 6)}"}
+        if route == "login":
+            return "POST", "/login", {"username": user.username,
+                                      "password": "password"}
+        raise ValueError(f"Unknown route: {route}")
+
+
+def run(num_requests, warmup, num_users, seed):
+    """Send the requests; returns {route: (timings, query counts,
+    statuses)} and the seconds the measured part took."""
+
+    rng = random.Random(seed)
+    workload = Workload(rng)
+
+    chosen = rng.sample(sorted(zip(workload.user_ids, workload.usernames)),
+                        min(num_users, len(workload.user_ids)))
+    users = [VirtualUser(number, user_id, username)
+             for number, (user_id, username) in enumerate(chosen)]
+    for user in users:
+        response = user.login()
+        if response.status_code != 302:
+            raise RuntimeError(f"Couldn't log in as {user.username} "
+                               f"({response.status_code})")
+
+    routes = [route for route, _ in WORKLOAD]
+    weights = [weight for _, weight in WORKLOAD]
+    stats = {route: ([], [], Counter()) for route in routes}
+
+    started = None
+    for i in range(warmup + num_requests):
+        if i == warmup:
+            started = time.perf_counter()
+
+        route = rng.choices(routes, weights)[0]
+        user = rng.choice(users)
+        method, path, data = workload.request(route, user)
+
+        with count_queries() as counter:
+            start = time.perf_counter()
+            response = user.client.open(path, method=method, data=data)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+        response.close()
+
+        if i >= warmup:
+            timings, queries, statuses = stats[route]
+            timings.append(elapsed)
+            queries.append(counter.count)
+            statuses[response.status_code] += 1
+
+    return stats, time.perf_counter() - started
+
+
+def report(stats, wall_seconds):
+    """Results per route and for "all" requests."""
+
+    def summary(timings, queries, statuses):
+        result = summarize(timings)
+        result.update(
+            rps=len(timings) / sum(timings) if timings else None,
+            queries_per_request=(sum(queries) / len(queries)
+                                 if queries else None),
+            max_queries=max(queries, default=None),
+            statuses={str(code): count
+                      for code, count in sorted(statuses.items())},
+            errors=sum(count for code, count in statuses.items()
+                       if code >= 400))
+        return result
+
+    results = {route: summary(*route_stats)
+               for route, route_stats in stats.items() if route_stats[0]}
+
+    timings, queries, statuses = [], [], Counter()
+    for route_timings, route_queries, route_statuses in stats.values():
+        timings += route_timings
+        queries += route_queries
+        statuses += route_statuses
+    results["all"] = summary(timings, queries, statuses)
+    # all together, it's requests over the whole run's wall time
+    results["all"]["rps"] = len(timings) / wall_seconds
+    return results
+
+
+def print_results(results):
+    print(f"{'route':<12} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'req/s':>8} {'queries':>8} {'errors':>6}")
+    for route, result in results.items():
+        print(f"{route:<12} {result['count']:>6} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['rps']:>8.1f} {result['queries_per_request']:>8.1f} "
+              f"{result['errors']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scale", type=float, default=1,
+                        help="dataset size, as for create_csvs.py")
+    parser.add_argument("--no-seed", action="store_true",
+                        help="use the data already in the database")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20,
+                        help="virtual users to spread requests over")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="for the dataset and the request sequence")
+    parser.add_argument("--out", help="results file (default: "
+                        "benchmarks/results/http-<commit>.json)")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed_database(args.scale, args.seed, echo=lambda line: None)
+    dataset = dataset_size()
+    print("dataset: " + ", ".join(f"{count} {table}"
+                                  for table, count in dataset.items()))
+
+    stats, wall_seconds = run(args.requests, args.warmup, args.users,
+                              args.seed)
+    results = report(stats, wall_seconds)
+    print_results(results)
+
+    out = args.out or os.path.join(
+        ROOT, "benchmarks", "results",
+        f"http-{(current_commit() or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    write_results(out, "http", vars(args), results, dataset)
+    print(f"wrote {out}")
@@ -0,0 +1,257 @@
+"""Micro-benchmarks of model-level hot paths, at several data sizes.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.micro
+    python -m benchmarks.micro --compare before.json after.json
+
+For each size in `--sizes` (default 10, 1000 and 100000) the database is
+REPLACED with a dataset built around one "hub" user, who follows `size`
+users and is followed by `size` users, and whose home feed draws on
+max(size, 100) messages. Then each benchmark in BENCHMARKS is timed call by
+call, for at least `--min-time` seconds and `--min-runs` calls, with its
+setup (a fresh session, say) done outside the timing. How many queries one
+call sends is counted separately, so counting doesn't slow the timed calls.
+
+Results (p50/p95/p99 per call, calls/s, queries) go to
+benchmarks/results/micro-<commit>.json, keyed "<benchmark>/<size>".
+
+--compare reads two results files (these or benchmarks.http_load's) and
+flags every benchmark whose p50 moved by more than `--threshold` (default
+10%); it exits with status 1 if anything got slower.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("DATABASE_URL", "postgresql:///warbler-bench")
+
+from flask import g, render_template
+
+from app import app, principals, fragments
+from benchmarks.common import (ROOT, compare, current_commit, summarize,
+                               write_results)
+from feed import feed_items, feed_query
+from models import db, User, Message, Follows
+from querycount import count_queries
+from timeline import MemoryTimelineStore, home_timeline
+
+SIZES = [10, 1000, 100000]
+
+# bcrypt of "password", at the default cost
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+HUB = 1
+
+
+def build_dataset(size):
+    """Recreate the tables with a hub user (id 1) who follows users
+    2..size+1 and is followed by users size+2..2*size+1."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    num_users = 2 * size + 1
+    db.session.execute(db.insert(User), [
+        {"id": user_id, "username": f"user{user_id}",
+         "email": f"user{user_id}@example.com", "password": PASSWORD}
+        for user_id in range(1, num_users + 1)])
+
+    followed = range(2, size + 2)
+    followers = range(size + 2, num_users + 1)
+    db.session.execute(db.insert(Follows), [
+        {"user_being_followed_id": user_id, "user_following_id": HUB}
+        for user_id in followed] + [
+        {"user_being_followed_id": HUB, "user_following_id": user_id}
+        for user_id in followers])
+
+    # the feed's messages, spread over everyone the hub follows
+    now = datetime.datetime(2024, 1, 1)
+    authors = itertools.cycle(followed)
+    db.session.execute(db.insert(Message), [
+        {"id": message_id, "text": f"Message {message_id}",
+         "timestamp": now - datetime.timedelta(minutes=message_id),
+         "user_id": next(authors)}
+        for message_id in range(1, max(size, 100) + 1)])
+
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+    db.session.remove()
+
+    return {"followed": list(followed), "followers": list(followers)}
+
+
+def fresh_session():
+    """A new request would start with an empty identity map."""
+
+    db.session.remove()
+
+
+def bench_is_following(data, rng):
+    fresh_session()
+    hub = db.session.get(User, HUB)
+    other = db.session.get(User, rng.choice(data["followed"]))
+    return lambda: hub.is_following(other)
+
+
+def bench_is_followed_by(data, rng):
+    fresh_session()
+    hub = db.session.get(User, HUB)
+    other = db.session.get(User, rng.choice(data["followers"]))
+    return lambda: hub.is_followed_by(other)
+
+
+def bench_authenticate(data, rng):
+    fresh_session()
+    return lambda: User.authenticate(f"user{HUB}", "password")
+
+
+def bench_signup(data, rng):
+    db.session.rollback()
+    name = f"new{rng.randrange(10 ** 9)}"
+
+    def signup():
+        User.signup(name, f"{name}@example.com", "password", None)
+        db.session.flush()
+
+    return signup
+
+
+def bench_feed_query(data, rng):
+    # a cold timeline: built from the database, then the page hydrated
+    fresh_session()
+    store = MemoryTimelineStore()
+    return lambda: home_timeline(store, HUB, 100)
+
+
+def render_home(messages):
+    with app.test_request_context("/"):
+        g.user = principals.get(HUB)
+        return render_template("home.html", messages=messages, likes=set(),
+                               like_counts={}, next_cursor=None)
+
+
+def bench_render_home(data, rng):
+    # every message card rendered from scratch
+    fresh_session()
+    fragments.clear()
+    principals.clear()
+    messages = feed_items(feed_query().order_by(Message.id).limit(100))
+    principals.get(HUB)
+    return lambda: render_home(messages)
+
+
+def bench_render_home_cached(data, rng):
+    # the usual case: message cards come from the fragment cache
+    fresh_session()
+    messages = feed_items(feed_query().order_by(Message.id).limit(100))
+    render_home(messages)
+    return lambda: render_home(messages)
+
+
+BENCHMARKS = {
+    "is_following": bench_is_following,
+    "is_followed_by": bench_is_followed_by,
+    "authenticate": bench_authenticate,
+    "signup": bench_signup,
+    "feed_query": bench_feed_query,
+    "render_home": bench_render_home,
+    "render_home_cached": bench_render_home_cached,
+}
+
+
+def measure(setup, data, rng, min_time, min_runs, max_runs=100000):
+    """Time calls of what `setup` returns, one setup per call."""
+
+    call = setup(data, rng)
+    with count_queries() as counter:
+        call()
+    queries = counter.count
+
+    timings = []
+    while len(timings) < max_runs and (len(timings) < min_runs
+                                       or sum(timings) < min_time):
+        call = setup(data, rng)
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+
+    db.session.rollback()
+    result = summarize(timings)
+    result.update(rps=len(timings) / sum(timings), queries=queries)
+    return result
+
+
+def run(sizes, names, min_time, min_runs, seed):
+    results = {}
+    for size in sizes:
+        data = build_dataset(size)
+        for name in names:
+            rng = random.Random(seed)
+            key = f"{name}/{size}"
+            results[key] = measure(BENCHMARKS[name], data, rng, min_time,
+                                   min_runs)
+            print(f"{key:<28} p50 {results[key]['p50_ms']:>9.3f} ms  "
+                  f"p95 {results[key]['p95_ms']:>9.3f} ms  "
+                  f"{results[key]['queries']:>3} queries", flush=True)
+    return results
+
+
+def print_comparison(old, new, rows, threshold):
+    print(f"{(old['commit'] or '?')[:10]} -> {(new['commit'] or '?')[:10]}"
+          f" (p50, flagging changes over {threshold:.0%})")
+    for name, before, after, change, verdict in rows:
+        print(f"{name:<28} {before:>10.3f} {after:>10.3f} ms "
+              f"{change:>+8.1%}  {verdict}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma-separated follow counts")
+    parser.add_argument("--only", help="comma-separated benchmark names")
+    parser.add_argument("--min-time", type=float, default=1.0,
+                        help="seconds to spend on each benchmark at least")
+    parser.add_argument("--min-runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="results file (default: "
+                        "benchmarks/results/micro-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two results files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change to flag, e.g. 0.10 for 10%%")
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        rows = compare(*reports, args.threshold)
+        print_comparison(*reports, rows, args.threshold)
+        sys.exit(1 if any(row[-1] == "slower" for row in rows) else 0)
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    results = run(sizes, names, args.min_time, args.min_runs, args.seed)
+
+    out = args.out or os.path.join(
+        ROOT, "benchmarks", "results",
+        f"micro-{(current_commit() or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    params = dict(vars(args), sizes=sizes, only=names)
+    write_results(out, "micro", params, results)
+    print(f"wrote {out}")
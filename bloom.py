@@ -0,0 +1,59 @@
+"""A Bloom filter: a compact set that can only answer "no" or "maybe".
+
+Used to check whether a username or email is taken without asking the
+database: if the filter says no, it's free. Only "maybe" (a name that is
+taken, or a false positive at about `error_rate`) needs a query to confirm.
+
+Items can't be removed. A deleted user's name stays "maybe" until the
+filter is rebuilt, which costs a query per check but is never wrong.
+"""
+
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """Bloom filter sized for `capacity` items at `error_rate`."""
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # optimal sizes for n items at false-positive rate p:
+        #   m = -n ln p / (ln 2)^2 bits, k = m/n ln 2 hash functions
+        self.num_bits = max(8, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(
+            self.num_bits / capacity * math.log(2)))
+
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        # k positions from two 64-bit hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        """False if `item` was never added; True if it probably was."""
+
+        return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    @property
+    def full(self):
+        """Has it had more items than it was sized for?"""
+
+        return self.count > self.capacity
@@ -0,0 +1,163 @@
+"""gzip compression of HTML and JSON responses, as WSGI middleware.
+
+Responses are compressed when the client accepts gzip, the content type is
+one we compress, nothing has encoded the body already (e.g. precompressed
+assets), and the body is at least `min_size` bytes. Small bodies aren't
+worth the CPU or the gzip framing.
+
+The body is compressed chunk by chunk as the app produces it, so a large
+or streamed response is never held in memory whole. When the app doesn't
+say how long the body is, we only buffer up to `min_size` bytes to decide.
+
+stats() reports bytes in and out and the CPU time spent compressing, to
+show whether it pays for itself.
+"""
+
+import itertools
+import threading
+import time
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+COMPRESSIBLE_TYPES = {"text/html", "application/json"}
+
+
+class CompressionMiddleware:
+    """Wrap a WSGI app to gzip its HTML and JSON responses."""
+
+    def __init__(self, app, min_size=500, level=6,
+                 types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.types = types
+        self._lock = threading.Lock()
+        self._counts = {"compressed": 0, "too_small": 0,
+                        "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+
+    def __call__(self, environ, start_response):
+        accepts_gzip = parse_accept_header(
+            environ.get("HTTP_ACCEPT_ENCODING")).quality("gzip") > 0
+        response = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            if exc_info and response.get("started"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response.update(status=status, headers=Headers(headers),
+                            exc_info=exc_info)
+            return written.append
+
+        body = self.app(environ, capture)
+        return self._respond(environ, body, response, written, accepts_gzip,
+                             start_response)
+
+    def _compressible(self, environ, status, headers):
+        mimetype = headers.get("Content-Type", "").split(";")[0].strip()
+        return (mimetype in self.types
+                and environ["REQUEST_METHOD"] != "HEAD"
+                and not status.startswith(("204", "304"))
+                and "Content-Encoding" not in headers
+                and "no-transform" not in headers.get("Cache-Control", ""))
+
+    def _respond(self, environ, body, response, written, accepts_gzip,
+                 start_response):
+        try:
+            chunks = iter(body)
+
+            # start_response may be called as late as the first chunk
+            first = [chunk for chunk in [next(chunks, b"")] if chunk]
+            status, headers = response["status"], response["headers"]
+
+            if not self._compressible(environ, status, headers):
+                response["started"] = True
+                start_response(status, headers.to_wsgi_list(),
+                               response["exc_info"])
+                yield from written
+                yield from first
+                yield from chunks
+                return
+
+            vary = {value.strip() for value in
+                    ",".join(headers.getlist("Vary")).split(",")
+                    if value.strip()}
+            headers["Vary"] = ", ".join(sorted(vary | {"Accept-Encoding"}))
+
+            # read just enough to tell whether the body is big enough
+            head = written + first
+            length = headers.get("Content-Length", type=int)
+            if accepts_gzip and length is None:
+                size = sum(len(chunk) for chunk in head)
+                for chunk in chunks:
+                    head.append(chunk)
+                    size += len(chunk)
+                    if size >= self.min_size:
+                        break
+                else:
+                    length = size
+
+            if not accepts_gzip or (length is not None
+                                    and length < self.min_size):
+                if accepts_gzip:
+                    self._count(too_small=1)
+                response["started"] = True
+                start_response(status, headers.to_wsgi_list(),
+                               response["exc_info"])
+                yield from head
+                yield from chunks
+                return
+
+            headers.remove("Content-Length")
+            headers["Content-Encoding"] = "gzip"
+            etag = headers.get("ETag")
+            if etag and not etag.startswith("W/"):
+                # same content, different bytes
+                headers["ETag"] = f"W/{etag}"
+
+            response["started"] = True
+            start_response(status, headers.to_wsgi_list(),
+                           response["exc_info"])
+
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            bytes_in = bytes_out = 0
+            cpu = 0.0
+            try:
+                for chunk in itertools.chain(head, chunks):
+                    start = time.thread_time()
+                    compressed = compressor.compress(chunk)
+                    cpu += time.thread_time() - start
+                    bytes_in += len(chunk)
+                    if compressed:
+                        bytes_out += len(compressed)
+                        yield compressed
+
+                start = time.thread_time()
+                compressed = compressor.flush()
+                cpu += time.thread_time() - start
+                bytes_out += len(compressed)
+                yield compressed
+            finally:
+                self._count(compressed=1, bytes_in=bytes_in,
+                            bytes_out=bytes_out, cpu_seconds=cpu)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._counts[name] += delta
+
+    def stats(self):
+        """Counters, plus the overall compression ratio (out / in)."""
+
+        with self._lock:
+            stats = dict(self._counts, min_size=self.min_size,
+                         level=self.level)
+        stats["ratio"] = (stats["bytes_out"] / stats["bytes_in"]
+                          if stats["bytes_in"] else None)
+        return stats
+
@@ -0,0 +1,495 @@
+"""The user directory at /users: browsing and searching by username.
+
+Both are cursor-paginated. Browsing walks usernames in order on their
+unique index. Searching finds usernames containing the query (ignoring
+case), and ranks those that start with it first, then the rest, each group
+in username order. A page's cursor is the (rank, username) of its last
+user.
+
+Substring search can't use a btree index (the pattern starts with a
+wildcard). On Postgres it uses the ix_users_username_trgm trigram index.
+SQLite has no such thing, so there we keep an in-process index of each
+username's trigrams instead, built on first use and updated by the signup,
+profile and delete routes. Changes made by other workers won't show up in
+it until they restart; SQLite is only for development anyway.
+
+As-you-type lookup (/users/typeahead) doesn't touch the database at all: a
+PrefixIndex keeps every username in a sorted array, so the usernames
+starting with some prefix are a binary search and a short slice away. Each
+worker loads its own on first use and applies the renames, signups and
+deletes it handles itself. Other workers' changes appear only once the
+index is rebuilt: in the background, after it's `max_age` seconds old (see
+Snapshot).
+
+/users/available checks whether a username or email is taken with
+TakenNames: a Bloom filter of every username and email, which answers most
+"is it free?" checks without a query. Each worker has its own filter, which
+misses names signed up through other workers until it's rebuilt in the
+background (again, once it's `max_age` seconds old). That's close enough
+for a hint as the form is typed in, and the filter only serves that:
+signup always checks a name with a query before spending a bcrypt hash on
+the new password.
+"""
+
+import base64
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from flask import abort, request
+
+from bloom import BloomFilter
+from models import db, User
+from pagination import Page
+
+PREFIX, SUBSTRING = 0, 1
+
+
+def encode_cursor(rank, username):
+    """Make an opaque, URL-safe cursor for (rank, username)."""
+
+    raw = f"{rank}|{username}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (rank, username); ValueError if it's bad."""
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, username = (
+            base64.urlsafe_b64decode(padded).decode().split("|", 1))
+        return int(rank), username
+    except (ValueError, TypeError) as err:
+        raise ValueError(f"Bad cursor: {cursor!r}") from err
+
+
+def cursor_from_request():
+    """The (rank, username) from ?after=..., or None for page one."""
+
+    cursor = request.args.get("after")
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards, for use with escape="\\"."""
+
+    return (text.replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def trigrams(text):
+    """The set of three-character substrings of `text`."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NgramIndex:
+    """Usernames indexed by their (lowercased) trigrams."""
+
+    def __init__(self):
+        self.loaded = False
+        self._names = {}
+        self._postings = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Index every user in the database."""
+
+        rows = db.session.query(User.id, User.username).all()
+        with self._lock:
+            self._names.clear()
+            self._postings.clear()
+            for user_id, username in rows:
+                self._add(user_id, username)
+            self.loaded = True
+
+    def _add(self, user_id, username):
+        self._names[user_id] = username
+        for gram in trigrams(username.lower()):
+            self._postings[gram].add(user_id)
+
+    def _remove(self, user_id):
+        username = self._names.pop(user_id, None)
+        if username is None:
+            return
+        for gram in trigrams(username.lower()):
+            self._postings[gram].discard(user_id)
+            if not self._postings[gram]:
+                del self._postings[gram]
+
+    def put(self, user_id, username):
+        """Add a user, or update their username."""
+
+        with self._lock:
+            if self.loaded:
+                self._remove(user_id)
+                self._add(user_id, username)
+
+    def remove(self, user_id):
+        with self._lock:
+            if self.loaded:
+                self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self._postings.clear()
+            self.loaded = False
+
+    def search(self, query):
+        """(rank, username, user_id) for every username containing
+        `query`, best first."""
+
+        if not self.loaded:
+            self.load()
+
+        query = query.lower()
+        with self._lock:
+            grams = trigrams(query)
+            if grams:
+                candidates = set.intersection(
+                    *(self._postings.get(gram, set()) for gram in grams))
+            else:
+                # too short to have a trigram; check every name
+                candidates = self._names.keys()
+
+            matches = []
+            for user_id in candidates:
+                username = self._names[user_id]
+                lowered = username.lower()
+                if lowered.startswith(query):
+                    matches.append((PREFIX, username, user_id))
+                elif query in lowered:
+                    matches.append((SUBSTRING, username, user_id))
+
+        matches.sort()
+        return matches
+
+
+class Snapshot:
+    """Something built from the whole users table, in one worker.
+
+    Other workers' signups, renames and deletes don't reach it, so it's
+    rebuilt once it's `max_age` seconds old. The first use builds it on the
+    spot; after that, the first use past `max_age` starts a rebuild in a
+    background thread and carries on with the old copy, so no request waits
+    on the full-table query. Changes this worker makes while a rebuild is
+    running are replayed onto the new copy.
+
+    Subclasses give the `columns` to load and define build(rows), which
+    makes a new copy, install(copy), and apply(*change), which makes one
+    change; the last two are called with _lock held.
+    """
+
+    columns = ()
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.loaded_at = None
+        # set (with _lock held) to rebuild on next use, whatever the age
+        self.stale = False
+        self.rebuilding = None
+        self._replay = []
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def load(self, engine=None):
+        """Build from the database now, on a connection of its own."""
+
+        with (engine or db.engine).connect() as conn:
+            rows = conn.execute(db.select(*self.columns)).all()
+        built = self.build(rows)
+        with self._lock:
+            self.install(built)
+            for change in self._replay:
+                self.apply(*change)
+            self._replay = []
+            self.loaded_at = time.monotonic()
+            self.stale = False
+
+    def refresh(self):
+        """Make sure there's a copy, and rebuild it if it's too old."""
+
+        if not self.loaded:
+            self.load()
+        elif (self.stale
+              or time.monotonic() - self.loaded_at > self.max_age):
+            self.rebuild_in_background()
+
+    def rebuild_in_background(self):
+        with self._lock:
+            if self.rebuilding:
+                return
+            # the thread has no app context, so hand it the engine
+            self.rebuilding = threading.Thread(
+                target=self._rebuild, args=(db.engine,), daemon=True)
+        self.rebuilding.start()
+
+    def _rebuild(self, engine):
+        try:
+            self.load(engine)
+        finally:
+            with self._lock:
+                self.rebuilding = None
+
+    def change(self, *change):
+        """Apply a change made by this worker (if there's a copy yet)."""
+
+        with self._lock:
+            if not self.loaded:
+                return
+            self.apply(*change)
+            if self.rebuilding:
+                self._replay.append(change)
+
+    def clear(self):
+        with self._lock:
+            self.install(self.build([]))
+            self._replay = []
+            self.loaded_at = None
+
+
+class PrefixIndex(Snapshot):
+    """Usernames in a sorted array, for finding those with a prefix."""
+
+    columns = (User.id, User.username)
+
+    def __init__(self, max_age=60):
+        super().__init__(max_age)
+        # parallel arrays sorted by lowercased username (then id)
+        self._keys, self._users, self._names = [], [], {}
+
+    def build(self, rows):
+        entries = sorted(((username.lower(), user_id), (user_id, username))
+                         for user_id, username in rows)
+        return ([key for key, _ in entries], [user for _, user in entries],
+                {user_id: username for user_id, username in rows})
+
+    def install(self, built):
+        self._keys, self._users, self._names = built
+
+    def apply(self, user_id, username=None):
+        """Remove a user, then add them back as `username` if it's given."""
+
+        old = self._names.pop(user_id, None)
+        if old is not None:
+            i = bisect.bisect_left(self._keys, (old.lower(), user_id))
+            del self._keys[i]
+            del self._users[i]
+        if username is not None:
+            key = (username.lower(), user_id)
+            i = bisect.bisect_left(self._keys, key)
+            self._keys.insert(i, key)
+            self._users.insert(i, (user_id, username))
+            self._names[user_id] = username
+
+    def put(self, user_id, username):
+        """Add a user, or update their username."""
+
+        self.change(user_id, username)
+
+    def remove(self, user_id):
+        self.change(user_id)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def search(self, prefix, limit=10):
+        """Up to `limit` (user_id, username) whose username starts with
+        `prefix` (ignoring case), in username order."""
+
+        self.refresh()
+
+        prefix = prefix.lower()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            found = []
+            for key, user in zip(self._keys[i:i + limit],
+                                 self._users[i:i + limit]):
+                if not key[0].startswith(prefix):
+                    break
+                found.append(user)
+        return found
+
+
+class TakenNames(Snapshot):
+    """Usernames and emails in use, behind a Bloom filter.
+
+    Names the filter hasn't seen are free, as far as this worker knows. For
+    the rest we ask the database; `false_positives` counts the times that
+    said it was free. Other workers' signups reach the filter when it's
+    rebuilt (see Snapshot); `missed` counts confirmed checks that found a
+    name the filter lacked.
+    """
+
+    columns = (User.username, User.email)
+
+    def __init__(self, error_rate=0.01, max_age=60):
+        super().__init__(max_age)
+        self.error_rate = error_rate
+        self.filter = None
+        self._counts = {"checks": 0, "queries": 0, "false_positives": 0,
+                        "missed": 0}
+
+    def build(self, rows):
+        """A filter of these (username, email) rows, with room to grow."""
+
+        bloom = BloomFilter(capacity=max(10000, 4 * len(rows)),
+                            error_rate=self.error_rate)
+        for username, email in rows:
+            bloom.add(f"username:{username}")
+            bloom.add(f"email:{email}")
+        return bloom
+
+    def install(self, bloom):
+        self.filter = bloom
+
+    def apply(self, username, email):
+        self.filter.add(f"username:{username}")
+        self.filter.add(f"email:{email}")
+        if self.filter.full:
+            # past its capacity the error rate climbs; rebuild it bigger
+            self.stale = True
+
+    def add(self, user):
+        self.change(user.username, user.email)
+
+    def is_taken(self, column, value, confirm=False):
+        """Does some user have `value` in `column` (User.username or
+        User.email)?
+
+        With confirm=True a "free" answer from the filter is checked with a
+        query too, so names from other workers aren't missed.
+        """
+
+        self.refresh()
+
+        self._count(checks=1)
+        maybe = f"{column.key}:{value}" in self.filter
+        if not maybe and not confirm:
+            return False
+
+        taken = db.session.query(
+            User.query.filter(column == value).exists()).scalar()
+        self._count(queries=1, false_positives=int(maybe and not taken),
+                    missed=int(taken and not maybe))
+        return taken
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._counts[name] += delta
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            if self.loaded:
+                stats.update(items=self.filter.count,
+                             capacity=self.filter.capacity,
+                             bytes=(self.filter.num_bits + 7) // 8)
+        return stats
+
+
+class UserDirectory:
+    """One page at a time of all users, or of a search."""
+
+    def __init__(self, prefix_max_age=60, taken_max_age=60):
+        self.ngrams = NgramIndex()
+        self.prefixes = PrefixIndex(max_age=prefix_max_age)
+        self.taken = TakenNames(max_age=taken_max_age)
+
+    def put(self, user):
+        """Keep the search indexes in step with a new or renamed user."""
+
+        self.ngrams.put(user.id, user.username)
+        self.prefixes.put(user.id, user.username)
+        self.taken.add(user)
+
+    def remove(self, user_id):
+        self.ngrams.remove(user_id)
+        self.prefixes.remove(user_id)
+
+    def clear(self):
+        self.ngrams.clear()
+        self.prefixes.clear()
+        self.taken.clear()
+
+    def username_taken(self, username, confirm=False):
+        return self.taken.is_taken(User.username, username, confirm)
+
+    def email_taken(self, email, confirm=False):
+        return self.taken.is_taken(User.email, email, confirm)
+
+    def typeahead(self, prefix, limit=10):
+        """Up to `limit` (user_id, username) starting with `prefix`."""
+
+        if not prefix:
+            return []
+        return self.prefixes.search(prefix, limit)
+
+    def page(self, query, cursor, limit):
+        """A Page of Users matching `query` (all users if it's empty)."""
+
+        if not query:
+            return self._browse(cursor, limit)
+        if db.engine.dialect.name == "sqlite":
+            return self._search_ngrams(query, cursor, limit)
+        return self._search_sql(query, cursor, limit)
+
+    def _browse(self, cursor, limit):
+        users = User.query.order_by(User.username)
+        if cursor:
+            users = users.filter(User.username > cursor[1])
+        return _make_page([(PREFIX, user) for user in
+                           users.limit(limit + 1)], limit)
+
+    def _search_sql(self, query, cursor, limit):
+        pattern = escape_like(query)
+        rank = db.case(
+            (User.username.ilike(f"{pattern}%", escape="\\"), PREFIX),
+            else_=SUBSTRING)
+
+        users = (db.session.query(rank, User)
+                 .filter(User.username.ilike(f"%{pattern}%", escape="\\")))
+        if cursor:
+            users = users.filter(db.tuple_(rank, User.username) > cursor)
+        users = users.order_by(rank, User.username).limit(limit + 1)
+
+        return _make_page([tuple(row) for row in users], limit)
+
+    def _search_ngrams(self, query, cursor, limit):
+        matches = self.ngrams.search(query)
+        if cursor:
+            matches = [match for match in matches if match[:2] > cursor]
+        matches = matches[:limit + 1]
+
+        users = User.query.filter(
+            User.id.in_([user_id for _, _, user_id in matches]))
+        by_id = {user.id: user for user in users}
+
+        return _make_page([(rank, by_id[user_id])
+                           for rank, _, user_id in matches
+                           if user_id in by_id], limit)
+
+
+def _make_page(ranked, limit):
+    """Page of Users from up to `limit + 1` (rank, User) pairs."""
+
+    users = [user for _, user in ranked]
+    if len(ranked) <= limit:
+        return Page(users, None)
+
+    rank, last = ranked[limit - 1]
+    return Page(users[:limit], encode_cursor(rank, last.username))
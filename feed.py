@@ -0,0 +1,65 @@
+"""Read-only rows for rendering message lists.
+
+Feed pages only read a handful of columns from each message and its author.
+Rather than building full Message and User objects (with identity-map and
+change-tracking bookkeeping) for every card, the feed queries select just
+those columns and return them as FeedItem tuples.
+"""
+
+from datetime import datetime
+from typing import NamedTuple
+
+from models import db, User, Message, Likes
+
+
+class FeedItem(NamedTuple):
+    """One message card: the message plus what we show of its author."""
+
+    id: int
+    text: str
+    timestamp: datetime
+    likes_count: int
+    user_id: int
+    username: str
+    image_url: str
+    author_version: int
+
+
+FEED_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.likes_count,
+    Message.user_id,
+    User.username,
+    User.image_url,
+    User.version,
+)
+
+
+def feed_query():
+    """Query for FeedItem columns; add filters, then pass to feed_items()."""
+
+    return (db.session.query(*FEED_COLUMNS)
+            .join(User, Message.user_id == User.id))
+
+
+def profile_feed_query(user_id):
+    """Messages posted by this user."""
+
+    return feed_query().filter(Message.user_id == user_id)
+
+
+def likes_feed_query(user_id):
+    """Messages this user has liked."""
+
+    return (feed_query()
+            .join(Likes, Likes.message_id == Message.id)
+            .filter(Likes.user_id == user_id))
+
+
+def feed_items(rows):
+    """Turn result rows from feed_query() into FeedItems."""
+
+    make = FeedItem._make
+    return [make(row) for row in rows]
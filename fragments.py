@@ -0,0 +1,91 @@
+"""Cache of rendered message-card HTML.
+
+A message card's body (avatar, @username, date, text) is the same for every
+viewer and almost never changes, so we render it once and reuse the HTML.
+Entries are keyed by message id and stamped with the author's `version`,
+which profile edits bump: a card rendered before the author changed their
+name or avatar no longer matches and is re-rendered. Deleted messages are
+evicted directly.
+
+Per-viewer parts of a card (like the like button) are rendered around the
+cached body as usual.
+
+The cache is a per-worker LRU bounded by the total size of the HTML kept.
+"""
+
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU cache of HTML fragments, bounded to about `max_bytes`."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Cached HTML for `key` rendered at `version`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, html):
+        """Cache HTML for `key` at `version`, evicting old entries to fit."""
+
+        cost = len(html)
+        if cost > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= len(old[1])
+
+            self._entries[key] = (version, html)
+            self.size += cost
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def evict(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def render(self, key, version, render):
+        """Cached HTML for `key`, calling render() to make it on a miss."""
+
+        html = self.get(key, version)
+        if html is None:
+            html = Markup(render())
+            self.put(key, version, html)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses}
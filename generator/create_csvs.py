@@ -3,75 +3,436 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py --scale 100 --seed 1 --shards 8
+
+`--scale 1` is the 300 users, 1000 messages and 5000 follows checked in
+here; everything grows linearly with it. (Below about scale 0.06 there
+aren't enough users for that many follows, and everyone follows everyone
+else instead.) The same scale and seed always
+give the same files, so benchmark datasets can be rebuilt anywhere. It needs
+numpy, and nothing from the network.
+
+The data is shaped like a real social network rather than uniformly random:
+
+- how many followers a user has follows a power law: most have a handful,
+  a few have a large share of all follows
+- how many people a user follows, and how much they post, are heavy-tailed
+  too
+
+Rows are sampled with numpy a block at a time and written as they're made,
+so memory use doesn't grow with the number of follows or messages.
+
+With `--shards N` each table is split into N files, made in parallel by a
+pool of `--workers` processes. Shard i holds users (and the follows of
+users) in the i-th range of ids, and the i-th range of message ids. Every
+(shard, table) file has its own random stream, derived from the seed, so
+the output only depends on --scale, --seed and --shards. manifest.json
+lists the files and their row counts; rows carry explicit ids, so shards
+can be loaded in any order or all at once.
+
+Load the result with `flask load-csvs generator`.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import functools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-MAX_WARBLER_LENGTH = 140
+import numpy as np
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+USERS_PER_SCALE = 300
+MESSAGES_PER_SCALE = 1000
+FOLLOWS_PER_SCALE = 5000
+
+BLOCK_ROWS = 100000
+# rounds of drawing by popularity before the rest of a follower's quota is
+# filled uniformly (see pick_followed)
+FOLLOW_ROUNDS = 4
+MAX_WARBLER_LENGTH = 140
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# messages are spread over the two years before this
+END = np.datetime64("2024-01-01T00:00:00", "us")
+SPAN = np.timedelta64(2 * 365 * 24 * 3600, "s").astype("timedelta64[us]")
 
-fake = Faker()
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio',
+                     'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-# Generate random profile image URLs to use for users
+# bcrypt of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+WORDS = np.array("""
+    able about account across act action add affect after again against
+    agree air all almost along already also always among and animal another
+    answer any appear area arm around art ask attack away back bad bag ball
+    bank bar base be bear beat beautiful because bed before begin behind best
+    better big bird bit black blue board body book both box boy break bring
+    brother build business buy call camera car card care carry case cat catch
+    cause center chair chance change check child choice church city claim
+    class clear close coach cold collection color come common company
+    computer condition could country course court cover cup cut dark data
+    day dead deal debate decide deep degree design detail dinner direction
+    dog door down draw dream drive drop during each early east easy eat edge
+    effect eight either else end energy enjoy enough enter even evening event
+    every exactly example expect experience eye face fact fall family far
+    fast father fear feel field fight film final find fine fire first fish
+    five floor fly follow food foot force forget form forward four free
+    friend front full fund game garden gas general get girl give glass go
+    goal good great green ground group grow guess gun guy hair half hand hang
+    happy hard have head hear heart heat heavy help here high hill history
+    hit hold home hope horse hot hotel hour house huge human hundred idea
+    image imagine impact inside island item job join just keep key kid kind
+    kitchen know land language large last late laugh law lay lead learn
+    leave left leg less letter level life light line list listen little live
+    local long look lose lot love low machine magazine main make man many map
+    market matter may meet member memory message method middle might mind
+    minute miss model modern moment money month more morning most mother
+    mountain mouth move movie music name nation nature near need network
+    never new news next nice night north note nothing notice now number ocean
+    offer office often oil old once one open order other out over own page
+    paint paper parent park part party pass past pay peace people perhaps
+    person phone pick picture piece place plan plant play point police pool
+    poor popular power present pretty price problem program project pull
+    push put quality question quick quiet race radio rain raise reach read
+    ready real reason red remember report rest rich right river road rock
+    role room rule run safe same save say scene school science sea season
+    seat second see sell send sense serve set seven shake share ship shoot
+    short show side sign simple sing sister sit six size skill skin sleep
+    small smile snow social soft some song soon sort sound south space speak
+    special sport spring stage stand star start state stay step still stock
+    stop store story street strong student study style summer sun table take
+    talk tax teach team tell ten test thank the then thing think three
+    through time today together tonight too top total tough town trade train
+    travel tree trip true try turn two type under until up use usually value
+    very view visit voice wait walk wall want war watch water way wear
+    weather week weight well west what when where while white whole why wide
+    wife will win wind window wish with without woman wonder word work world
+    write wrong yard yeah year yes yet you young
+""".split())
+
+LOCATIONS = np.array([
+    "Amsterdam", "Austin", "Berlin", "Bogota", "Boston", "Cairo", "Chicago",
+    "Denver", "Dublin", "Helsinki", "Istanbul", "Jakarta", "Lagos", "Lima",
+    "Lisbon", "London", "Madrid", "Melbourne", "Mexico City", "Montreal",
+    "Mumbai", "Nairobi", "Oakland", "Osaka", "Oslo", "Paris", "Portland",
+    "Prague", "Seattle", "Seoul", "Sydney", "Tokyo", "Toronto", "Vienna",
+])
+
+
+def sentences(rng, count, min_words, max_words, max_length):
+    """`count` random sentences of min_words..max_words words."""
+
+    lengths = rng.integers(min_words, max_words + 1, count)
+    words = WORDS[rng.integers(0, len(WORDS), (count, max_words))]
+    return [(" ".join(row[:length]).capitalize() + ".")[:max_length]
+            for row, length in zip(words, lengths)]
+
+
+def heavy_tailed(rng, count, shape):
+    """Positive weights with a Pareto tail (smaller shape, heavier tail)."""
+
+    return rng.pareto(shape, count) + 1
+
+
+def sample_ids(rng, cdf, count):
+    """Draw `count` user ids (1-based) with probability given by `cdf`."""
+
+    return np.searchsorted(cdf, rng.random(count) * cdf[-1]) + 1
+
+
+def substream(seed, *key):
+    """An independent random generator for one part of the dataset."""
+
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=key))
+
+
+@functools.lru_cache(maxsize=1)
+def user_weights(seed, num_users, num_follows):
+    """Per-user weights every shard shares (computed once per process).
+
+    Returns cumulative (activity, popularity) for sampling authors and
+    followed users, and how many users each user follows.
+    """
+
+    rng = substream(seed, 0)
+
+    # a few users post most of the messages
+    activity = np.cumsum(heavy_tailed(rng, num_users, 1.5))
+
+    # who gets followed: a power law, so a few accounts are huge
+    popularity = np.cumsum(heavy_tailed(rng, num_users, 1.1))
+
+    # how many each user follows: heavy-tailed, adding up to the target
+    appetite = heavy_tailed(rng, num_users, 2.0)
+    following = follow_quotas(appetite, num_follows, num_users - 1)
+
+    return activity, popularity, following
+
+
+def follow_quotas(appetite, total, cap):
+    """Whole numbers in proportion to `appetite`, none over `cap`, adding
+    up to `total` (or as near as the cap allows)."""
+
+    total = min(total, cap * len(appetite))
+    quotas = np.zeros(len(appetite))
+    capped = np.zeros(len(appetite), dtype=bool)
+    while True:
+        # share out what the capped users don't take
+        left = total - cap * capped.sum()
+        quotas[~capped] = (appetite[~capped] * left
+                           / appetite[~capped].sum())
+        over = ~capped & (quotas > cap)
+        if not over.any():
+            break
+        quotas[over] = cap
+        capped |= over
+
+    # round down, then give the shortfall to the largest remainders
+    whole = np.floor(quotas).astype(np.int64)
+    shortfall = total - int(whole.sum())
+    whole[np.argsort(whole - quotas, kind="stable")[:shortfall]] += 1
+    return whole
+
+
+def write_users(writer, rng, first, stop):
+    """Users with ids first..stop-1."""
+
+    for start in range(first, stop, BLOCK_ROWS):
+        count = min(BLOCK_ROWS, stop - start)
+        ids = np.arange(start, start + count)
+        names = WORDS[rng.integers(0, len(WORDS), count)]
+        images = rng.integers(0, len(IMAGE_URLS), count)
+        locations = LOCATIONS[rng.integers(0, len(LOCATIONS), count)]
+        bios = sentences(rng, count, 3, 10, 140)
+
+        writer.writerows(
+            (user_id, f"{name}{user_id}@example.com", f"{name}{user_id}",
+             IMAGE_URLS[image], PASSWORD, bio, HEADER_IMAGE_URL, location)
+            for user_id, name, image, bio, location
+            in zip(ids, names, images, bios, locations))
+
+    return stop - first
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+def write_messages(writer, rng, weights, first, stop):
+    """Messages with ids first..stop-1, by users picked by activity."""
+
+    activity, _, _ = weights
+
+    for start in range(first, stop, BLOCK_ROWS):
+        count = min(BLOCK_ROWS, stop - start)
+        user_ids = sample_ids(rng, activity, count)
+        ages = (rng.random(count) * SPAN.astype(np.int64)).astype(
+            "timedelta64[us]")
+        timestamps = np.char.replace(
+            np.datetime_as_string(END - ages, unit="us"), "T", " ")
+        texts = sentences(rng, count, 4, 25, MAX_WARBLER_LENGTH)
+
+        writer.writerows(zip(range(start, start + count), texts, timestamps,
+                             user_ids))
+
+    return stop - first
+
+
+def pick_followed(rng, popularity, first, wanted, num_users):
+    """Who followers first, first + 1, ... (1-based ids) follow: wanted[i]
+    distinct users each, never themselves. Returns (followers, followed),
+    grouped by follower.
+
+    Users are drawn by popularity. Popular accounts get drawn more than
+    once, so each round draws extra, drops repeats and self follows, and
+    keeps each follower's first picks; followers left short are drawn for
+    again. Whatever a few rounds can't find (say, a follower of nearly
+    everyone, who needs the least popular accounts too) is filled in
+    uniformly at random.
+    """
+
+    ids = np.arange(first, first + len(wanted))
+    followers = np.empty(0, dtype=np.int64)
+    followed = np.empty(0, dtype=np.int64)
+    needed = wanted.copy()
+
+    for _ in range(FOLLOW_ROUNDS):
+        short = needed > 0
+        if not short.any():
+            break
+
+        # earlier rounds' picks first, so repeats of them are dropped
+        drawn = np.repeat(ids[short],
+                          np.minimum(needed[short] * 2 + 2, num_users))
+        followers = np.concatenate([followers, drawn])
+        followed = np.concatenate(
+            [followed, sample_ids(rng, popularity, len(drawn))])
+
+        _, picks = np.unique(followers * (num_users + 1) + followed,
+                             return_index=True)
+        picks.sort()
+        picks = picks[followers[picks] != followed[picks]]
+        picks = picks[np.argsort(followers[picks], kind="stable")]
+        followers, followed = followers[picks], followed[picks]
+
+        rank = (np.arange(len(followers))
+                - np.searchsorted(followers, followers))
+        keep = rank < wanted[followers - first]
+        followers, followed = followers[keep], followed[keep]
+        needed = wanted - np.bincount(followers - first,
+                                      minlength=len(wanted))
+
+    if needed.any():
+        extra = [fill_followed(rng, follower, followed[followers == follower],
+                               count, num_users)
+                 for follower, count in zip(ids[needed > 0],
+                                            needed[needed > 0])]
+        followers = np.concatenate(
+            [followers] + [np.full(len(picks), follower)
+                           for follower, picks in zip(ids[needed > 0],
+                                                      extra)])
+        followed = np.concatenate([followed] + extra)
+        order = np.argsort(followers, kind="stable")
+        followers, followed = followers[order], followed[order]
+
+    return followers, followed
+
+
+def fill_followed(rng, follower, taken, count, num_users):
+    """`count` more users for `follower` to follow, uniformly at random,
+    other than themselves and those in `taken`."""
+
+    excluded = set(taken.tolist()) | {follower}
+    if count + len(excluded) > num_users // 2:
+        # most users are needed: pick from the ones left
+        left = np.setdiff1d(np.arange(1, num_users + 1),
+                            np.fromiter(excluded, dtype=np.int64))
+        return rng.choice(left, count, replace=False)
+
+    picks = []
+    while len(picks) < count:
+        for user_id in rng.integers(1, num_users + 1, 2 * count).tolist():
+            if user_id not in excluded and len(picks) < count:
+                excluded.add(user_id)
+                picks.append(user_id)
+    return np.array(picks, dtype=np.int64)
+
+
+def write_follows(writer, rng, weights, first, stop):
+    """Who users first..stop-1 follow; returns how many follows."""
+
+    _, popularity, following = weights
+    num_users = len(following)
+
+    written = 0
+    # whole followers at a time (indexes here are 0-based; ids are 1-based)
+    start, stop = first - 1, stop - 1
+    while start < stop:
+        end = start + 1
+        budget = following[start]
+        while end < stop and budget + following[end] <= BLOCK_ROWS:
+            budget += following[end]
+            end += 1
+
+        followers, followed = pick_followed(
+            rng, popularity, start + 1, following[start:end], num_users)
+
+        writer.writerows(zip(followed, followers))
+        written += len(followers)
+        start = end
+
+    return written
+
+TABLES = [
+    ("users", USERS_CSV_HEADERS),
+    ("messages", MESSAGES_CSV_HEADERS),
+    ("follows", FOLLOWS_CSV_HEADERS),
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def shard_range(total, shard, shards):
+    """Ids (1-based, end exclusive) of the shard-th of `shards` ranges."""
+
+    return total * shard // shards + 1, total * (shard + 1) // shards + 1
+
+
+def make_shard(out_dir, filename, table, shard, shards, seed, sizes):
+    """Write one table's shard; returns its row count."""
+
+    num_users, num_messages, num_follows = sizes
+    rng = substream(seed, 1, shard, [name for name, _ in TABLES].index(table))
+    weights = user_weights(seed, num_users, num_follows)
+
+    with open(os.path.join(out_dir, filename), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(dict(TABLES)[table])
+
+        if table == "users":
+            return write_users(writer, rng,
+                               *shard_range(num_users, shard, shards))
+        if table == "messages":
+            return write_messages(writer, rng, weights,
+                                  *shard_range(num_messages, shard, shards))
+        return write_follows(writer, rng, weights,
+                             *shard_range(num_users, shard, shards))
+
+
+def generate(out_dir, scale=1, seed=1, shards=1, workers=None):
+    """Write the CSVs and manifest.json into `out_dir`; returns the
+    manifest."""
+
+    sizes = (max(2, round(USERS_PER_SCALE * scale)),
+             round(MESSAGES_PER_SCALE * scale),
+             round(FOLLOWS_PER_SCALE * scale))
+
+    jobs = []
+    for shard in range(shards):
+        for table, _ in TABLES:
+            filename = (f"{table}.csv" if shards == 1
+                        else f"{table}.{shard:04d}.csv")
+            jobs.append((table, filename, shard))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make_shard, out_dir, filename, table, shard,
+                               shards, seed, sizes)
+                   for table, filename, shard in jobs]
+        rows = [future.result() for future in futures]
+
+    manifest = {
+        "scale": scale,
+        "seed": seed,
+        "shards": [{"table": table, "file": filename, "rows": count}
+                   for (table, filename, _), count in zip(jobs, rows)],
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scale", type=float, default=1,
+                        help="1 is 300 users, 1000 messages, 5000 follows")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=1,
+                        help="files per table")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes to use (default: one per CPU)")
+    parser.add_argument("--out", default=os.path.dirname(__file__),
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    manifest = generate(args.out, args.scale, args.seed, args.shards,
+                        args.workers)
+    totals = {}
+    for shard in manifest["shards"]:
+        totals[shard["table"]] = totals.get(shard["table"], 0) + shard["rows"]
+    print(", ".join(f"{count} {table}" for table, count in totals.items()))
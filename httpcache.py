@@ -0,0 +1,118 @@
+"""Conditional GETs and per-route Cache-Control.
+
+A profile or message page only changes when a few cheap-to-read values
+change: the user's version (bumped on profile edits), their counters, their
+newest message, and who is looking at it (the navbar and follow button
+depend on the viewer). We hash those into an ETag and answer If-None-Match
+with a 304 before loading anything else or rendering a template.
+
+Every view gets `Cache-Control: no-store` unless it declares otherwise with
+@cache_policy. Pages for logged-in users are always marked private, so a
+shared cache (our CDN) only ever keeps the anonymous version.
+"""
+
+import hashlib
+
+from flask import current_app, g, make_response, request, session
+
+from models import db, User, Message
+
+DEFAULT_POLICY = "no-store"
+
+
+def cache_policy(directives):
+    """Set the Cache-Control directives for a view's responses."""
+
+    def decorator(view):
+        view.cache_policy = directives
+        return view
+
+    return decorator
+
+
+def apply_cache_policy(response):
+    """Add the current view's Cache-Control, unless the response has one."""
+
+    if "Cache-Control" in response.headers:
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    directives = getattr(view, "cache_policy", DEFAULT_POLICY)
+    if directives != DEFAULT_POLICY and g.get("user"):
+        directives = f"private, {directives}"
+
+    response.headers["Cache-Control"] = directives
+    return response
+
+
+def make_etag(*parts):
+    """Hash some values (ids, versions, timestamps...) into an ETag."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+
+
+def viewer_parts(user_id):
+    """What a page about `user_id` depends on from the logged-in user."""
+
+    if not g.user:
+        return (None,)
+    return (g.user.id, g.user.version, user_id in g.user.followed_ids)
+
+
+def profile_etag(user_id):
+    """ETag for /users/<user_id>, or None if there's no such user."""
+
+    newest = (db.session.query(Message.timestamp, Message.id)
+              .filter(Message.user_id == user_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(1)
+              .subquery())
+
+    row = (db.session.query(User.version,
+                            User.messages_count,
+                            User.following_count,
+                            User.followers_count,
+                            User.likes_count,
+                            newest.c.timestamp,
+                            newest.c.id)
+           .outerjoin(newest, db.true())
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return None
+
+    return make_etag("users_show", user_id, tuple(row),
+                     *viewer_parts(user_id))
+
+
+def message_etag(message_id):
+    """ETag for /messages/<message_id>, or None if there's no such message."""
+
+    row = (db.session.query(Message.user_id, User.version)
+           .join(User, Message.user_id == User.id)
+           .filter(Message.id == message_id)
+           .first())
+    if row is None:
+        return None
+
+    return make_etag("messages_show", message_id, tuple(row),
+                     *viewer_parts(row.user_id))
+
+
+def conditional(etag, render):
+    """Respond 304 if the client already has `etag`, else call render().
+
+    Pages with flash messages waiting are always rendered (and not tagged),
+    since showing them uses them up.
+    """
+
+    if "_flashes" in session:
+        return make_response(render())
+
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,209 @@
+"""Fast bulk loading of CSVs (like those in generator/) into a fresh database.
+
+seed.py used to go through the ORM, building a dict and an INSERT per row,
+all in one transaction. `load_csvs()` instead:
+
+- creates the tables without their secondary indexes and foreign keys, and
+  adds those back once the data is in (building an index once is much
+  cheaper than updating it row by row)
+- streams each CSV to the database in chunks of `chunk_rows` rows,
+  committing after each: with COPY ... FROM STDIN on Postgres, and with
+  executemany INSERTs on SQLite
+- fills in the denormalized counters and ANALYZEs the tables at the end
+
+Each CSV is named after its table (users.csv -> users) and its header row
+names the columns. A directory with a manifest.json (as written by
+generator/create_csvs.py --shards N) can instead split a table over several
+files; those are loaded at the same time, `workers` at once, each on its
+own connection. Foreign keys are only added back at the end, so the order
+rows arrive in doesn't matter. SQLite has a single writer, so there shards
+load one at a time.
+
+Run it with `flask load-csvs generator`.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from sqlalchemy.schema import AddConstraint
+
+from models import db, User, Message
+
+
+def csv_chunks(path, chunk_rows):
+    """Yield (columns, rows) for each chunk of up to `chunk_rows` rows."""
+
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return
+            yield columns, rows
+
+
+def copy_rows(conn, table, columns, rows):
+    """COPY rows into a Postgres table (empty fields become NULL)."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(conn, table, columns, rows):
+    """INSERT rows with executemany (empty fields become NULL)."""
+
+    placeholders = ", ".join("?" for _ in columns)
+    conn.exec_driver_sql(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+        [tuple(value if value != "" else None for value in row)
+         for row in rows])
+
+
+def create_bare_tables():
+    """Drop and recreate every table, without secondary indexes or
+    foreign keys. Returns what was left out, to add back later."""
+
+    # whatever the session holds is about to be gone
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    deferred_indexes = []
+    deferred_keys = []
+    postgres = db.engine.dialect.name == "postgresql"
+    inspector = db.inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    index.drop(conn)
+                    deferred_indexes.append(index)
+
+            # SQLite doesn't enforce foreign keys unless asked, and can't
+            # drop them anyway
+            if postgres:
+                for fk in inspector.get_foreign_keys(table.name):
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE {table.name} '
+                        f'DROP CONSTRAINT "{fk["name"]}"')
+                deferred_keys.extend(table.foreign_key_constraints)
+
+    return deferred_indexes, deferred_keys
+
+
+def find_csvs(directory, tables):
+    """{table: [path, ...]} from manifest.json, or else <table>.csv files."""
+
+    manifest = os.path.join(directory, "manifest.json")
+    paths = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            for shard in json.load(f)["shards"]:
+                if shard["table"] in tables:
+                    paths.setdefault(shard["table"], []).append(
+                        os.path.join(directory, shard["file"]))
+        return paths
+
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        if ext == ".csv" and name in tables:
+            paths[name] = [os.path.join(directory, filename)]
+    return paths
+
+
+def load_file(engine, write_rows, table, path, chunk_rows):
+    """Load one CSV into `table` on a connection of its own; returns the
+    number of rows."""
+
+    count = 0
+    with engine.connect() as conn:
+        for columns, rows in csv_chunks(path, chunk_rows):
+            write_rows(conn, table, columns, rows)
+            conn.commit()
+            count += len(rows)
+    return count
+
+
+def reset_sequences(conn, tables):
+    """Move Postgres id sequences past ids that were loaded explicitly."""
+
+    for table in tables:
+        column = table.autoincrement_column
+        if column is not None:
+            conn.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence("
+                f"'{table.name}', '{column.name}'), max({column.name})) "
+                f"FROM {table.name} HAVING max({column.name}) IS NOT NULL")
+
+
+def load_csvs(directory, chunk_rows=50000, workers=4, echo=print):
+    """Load every table's CSV(s) in `directory` into a fresh database.
+
+    Returns {table: (rows, seconds)}.
+    """
+
+    tables = {table.name: table for table in db.metadata.sorted_tables}
+    paths = find_csvs(directory, tables)
+
+    deferred_indexes, deferred_keys = create_bare_tables()
+    engine = db.engine
+    postgres = engine.dialect.name == "postgresql"
+    write_rows = copy_rows if postgres else insert_rows
+    if not postgres:
+        workers = 1
+
+    loaded = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name in tables:
+            if name not in paths:
+                continue
+
+            start = time.perf_counter()
+            count = sum(pool.map(
+                lambda path: load_file(engine, write_rows, name, path,
+                                       chunk_rows),
+                paths[name]))
+
+            elapsed = time.perf_counter() - start
+            loaded[name] = (count, elapsed)
+            echo(f"{name}: {count} rows from {len(paths[name])} file(s) "
+                 f"in {elapsed:.1f}s "
+                 f"({count / elapsed if elapsed else 0:,.0f} rows/s)")
+
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        for index in deferred_indexes:
+            index.create(conn)
+        for fk in deferred_keys:
+            conn.execute(AddConstraint(fk))
+        if postgres:
+            reset_sequences(conn, [tables[name] for name in loaded])
+    echo(f"indexes and foreign keys: {time.perf_counter() - start:.1f}s")
+
+    # the CSVs don't carry the denormalized counters
+    start = time.perf_counter()
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    echo(f"counters and statistics: {time.perf_counter() - start:.1f}s")
+
+    return loaded
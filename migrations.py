@@ -0,0 +1,264 @@
+"""Bring an existing Warbler database up to date with models.py.
+
+db.create_all() only creates tables that don't exist yet; it won't add new
+columns or indexes to tables that are already there. `migrate()` (run it
+with `flask migrate`) does, and is safe to run any number of times.
+
+`check_query_plans()` (`flask check-query-plans`) EXPLAINs the main query
+behind each feed route and reports any that would scan the whole messages
+table: a sequential scan, or an index scan with no Index Cond (which walks
+every entry of the index). On Postgres the plans only mean much against
+ANALYZEd data of a realistic size (load one with generator/create_csvs.py
+and `flask load-csvs`); there the check leaves the planner alone. On a
+table too small for any index to pay off it turns sequential scans off, to
+at least see whether an index *can* be used.
+"""
+
+import json
+import re
+from datetime import datetime
+
+from sqlalchemy.schema import CreateColumn
+
+from models import db, User, Message
+from feed import profile_feed_query, likes_feed_query
+from pagination import page_query
+from timeline import timeline_query, author_streams_query
+
+
+def add_column(table, column):
+    """ALTER TABLE ... ADD COLUMN, using the column's definition in models.py.
+
+    New columns need a server_default if they're NOT NULL.
+    """
+
+    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+
+# Unique constraints that models.py used to declare: (table, columns)
+DROPPED_UNIQUES = [
+    # likes used to allow only one like per message, ever
+    ("likes", ["message_id"]),
+]
+
+
+def drop_stale_uniques(inspector):
+    """Drop unique constraints listed in DROPPED_UNIQUES, if present."""
+
+    dropped = []
+    for table, columns in DROPPED_UNIQUES:
+        if table not in inspector.get_table_names():
+            continue
+
+        for unique in inspector.get_unique_constraints(table):
+            if unique["column_names"] != columns:
+                continue
+
+            if db.engine.dialect.name == "sqlite":
+                # SQLite can't drop a constraint without rebuilding the table
+                raise RuntimeError(
+                    f"Can't drop UNIQUE ({', '.join(columns)}) on {table} "
+                    f"in SQLite; recreate the table instead.")
+
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(
+                    f'ALTER TABLE {table} DROP CONSTRAINT "{unique["name"]}"')
+            dropped.append(f"unique constraint {unique['name']}")
+
+    return dropped
+
+
+def migrate():
+    """Create any missing tables, columns and indexes, and drop unique
+    constraints that no longer apply.
+
+    Returns what was changed.
+    """
+
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    created = drop_stale_uniques(inspector)
+    if db.engine.dialect.name == "postgresql":
+        # for ix_users_username_trgm
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    db.create_all()
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            created.append(f"table {table.name}")
+            continue
+
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                add_column(table, column)
+                created.append(f"column {table.name}.{column.name}")
+
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        missing = [index for index in table.indexes
+                   if index.name not in existing]
+        for index in missing:
+            # skipped if it's for another database (ddl_if)
+            index.create(db.engine, checkfirst=True)
+        if missing:
+            now = {ix["name"] for ix in
+                   db.inspect(db.engine).get_indexes(table.name)}
+            created.extend(f"index {index.name}" for index in missing
+                           if index.name in now)
+
+    # new counter columns start at zero; fill them in
+    if any(name.startswith("column users.") and name.endswith("_count")
+           for name in created):
+        User.reconcile_counters()
+        db.session.commit()
+    if "table message_like_counts" in created:
+        Message.reconcile_counters()
+        db.session.commit()
+
+    return created
+
+
+##############################################################################
+# Query plan checks
+
+
+def route_queries(user_id):
+    """The main query behind each feed route, for this user.
+
+    Each is checked for the first page and for a page deep in the feed.
+    """
+
+    cursor = (datetime.utcnow(), 2 ** 31 - 1)
+    profile = profile_feed_query(user_id)
+    likes = likes_feed_query(user_id)
+
+    queries = {}
+    for page, before in [("first page", None), ("cursor page", cursor)]:
+        queries[f"users_show, {page}"] = page_query(profile, before, 100)
+        queries[f"show_all_liked_messages_page, {page}"] = (
+            page_query(likes, before, 100))
+        queries[f"homepage timeline rebuild, {page}"] = (
+            timeline_query(user_id, before=before))
+        queries[f"homepage pulled authors, {page}"] = (
+            author_streams_query([user_id], 101, before))
+
+    return {name: getattr(query, "statement", query)
+            for name, query in queries.items()}
+
+
+# Fewer rows than this and the Postgres planner rightly prefers scanning
+# the table, so the check turns sequential scans off
+SMALL_TABLE_ROWS = 10000
+
+
+def explain(statement):
+    """Get the query plan for a statement.
+
+    On Postgres, the root node of EXPLAIN (FORMAT JSON); on SQLite, the
+    lines of EXPLAIN QUERY PLAN.
+    """
+
+    conn = db.session.connection()
+    dialect = conn.dialect
+    compiled = statement.compile(
+        dialect=dialect, compile_kwargs={"render_postcompile": True})
+
+    params = compiled.params
+    if compiled.positiontup is not None:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    if dialect.name == "postgresql":
+        rows = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}",
+                                    params)
+        plan = rows.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
+    if dialect.name == "sqlite":
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params)
+        return [row[-1] for row in rows]
+
+    raise NotImplementedError(f"Can't EXPLAIN on {dialect.name}")
+
+
+def plan_nodes(node, depth=0):
+    """Every node of a Postgres JSON plan, as (depth, node)."""
+
+    yield depth, node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child, depth + 1)
+
+
+def scans_all_messages(node):
+    """Is this Postgres plan node a scan over the whole messages table?"""
+
+    if node.get("Relation Name") != "messages":
+        return False
+    if node["Node Type"] == "Seq Scan":
+        return True
+    # an index scan that isn't narrowed by a condition reads every entry
+    return (node["Node Type"] in ("Index Scan", "Index Only Scan")
+            and "Index Cond" not in node)
+
+
+def plan_lines(plan):
+    """A Postgres JSON plan as readable lines, one per node."""
+
+    lines = []
+    for depth, node in plan_nodes(plan):
+        line = node["Node Type"]
+        if "Index Name" in node:
+            line += f" using {node['Index Name']}"
+        if "Relation Name" in node:
+            line += f" on {node['Relation Name']}"
+        if "Index Cond" in node:
+            line += f" (Index Cond: {node['Index Cond']})"
+        lines.append("  " * depth + line)
+    return lines
+
+
+SEQ_SCAN = re.compile(r"^SCAN messages\b")
+
+
+def full_scans(plan):
+    """(plan as lines, whether it scans the whole messages table)."""
+
+    if isinstance(plan, dict):
+        return plan_lines(plan), any(scans_all_messages(node)
+                                     for _, node in plan_nodes(plan))
+    return plan, any(SEQ_SCAN.search(line.strip()) for line in plan)
+
+
+def check_query_plans(user_id=None):
+    """EXPLAIN every route query; return {route: plan} for those that scan
+    the whole messages table."""
+
+    if user_id is None:
+        user_id = db.session.query(db.func.min(User.id)).scalar() or 1
+
+    postgres = db.engine.dialect.name == "postgresql"
+    if postgres:
+        # plans follow the statistics, so make sure they're current
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE messages")
+
+    problems = {}
+    try:
+        if postgres and db.session.execute(db.text(
+                "SELECT reltuples FROM pg_class "
+                "WHERE oid = 'messages'::regclass")).scalar() < SMALL_TABLE_ROWS:
+            db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+
+        for name, statement in route_queries(user_id).items():
+            lines, scans = full_scans(explain(statement))
+            if scans:
+                problems[name] = lines
+    finally:
+        db.session.rollback()
+
+    return problems
@@ -1,13 +1,27 @@
 """SQLAlchemy models for Warbler."""
 
+import random
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from passwords import password_pool, PasswordPoolBusy
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# How many rows each message's like count is spread over (see LikeCount)
+LIKE_COUNT_SHARDS = 8
+
+
+def upsert_insert(dialect):
+    """The INSERT construct with ON CONFLICT support for this dialect."""
+
+    return {"postgresql": postgresql_insert,
+            "sqlite": sqlite_insert}[dialect.name]
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -45,9 +59,118 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    @classmethod
+    def state_for(cls, user_id, message_ids):
+        """Like state for just these messages, e.g. the ones on a page.
+
+        Returns (ids of those messages this user liked, {message id: like
+        count}), from one query with a LEFT JOIN over the page's ids.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set(), {}
+
+        rows = (db.session.query(Message.id, Message.likes_count, cls.id)
+                .outerjoin(cls, db.and_(cls.message_id == Message.id,
+                                        cls.user_id == user_id))
+                .filter(Message.id.in_(message_ids)))
+
+        liked = set()
+        counts = {}
+        for message_id, likes_count, like_id in rows:
+            counts[message_id] = likes_count
+            if like_id is not None:
+                liked.add(message_id)
+        return liked, counts
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message if this user hasn't yet, otherwise unlike it.
+
+        Each direction is one idempotent statement: a DELETE ... RETURNING,
+        or an INSERT ... ON CONFLICT DO NOTHING RETURNING, against the
+        unique (user_id, message_id) index. Counters are only bumped when a
+        row actually changed, so double-submits can't skew them. (These are
+        Core statements, so the ORM's counter events don't see them.)
+
+        Returns True if the message is now liked.
+        """
+
+        unliked = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .returning(cls.id)
+        ).first()
+        if unliked:
+            User.bump(user_id, likes_count=-1)
+            LikeCount.add(message_id, -1)
+            return False
+
+        liked = db.session.execute(
+            upsert_insert(db.session.get_bind().dialect)(cls)
+            .values(user_id=user_id, message_id=message_id)
+            .on_conflict_do_nothing(index_elements=["user_id", "message_id"])
+            .returning(cls.id)
+        ).first()
+        if liked:
+            User.bump(user_id, likes_count=1)
+            LikeCount.add(message_id, 1)
+        return True
+
+
+class LikeCount(db.Model):
+    """One slice of a message's like count.
+
+    A single counter on the message row would make every concurrent like
+    of a popular message wait for that row's lock. Instead each like or
+    unlike adds to one of LIKE_COUNT_SHARDS rows, picked at random, and
+    Message.likes_count sums them.
+    """
+
+    __tablename__ = 'message_like_counts'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    @classmethod
+    def add_statement(cls, message_id, delta, dialect):
+        """INSERT ... ON CONFLICT DO UPDATE adding `delta` to a random
+        shard of this message's count."""
+
+        table = cls.__table__
+        return (upsert_insert(dialect)(table)
+                .values(message_id=message_id,
+                        shard=random.randrange(LIKE_COUNT_SHARDS),
+                        likes=delta)
+                .on_conflict_do_update(
+                    index_elements=["message_id", "shard"],
+                    set_={"likes": table.c.likes + delta}))
+
+    @classmethod
+    def add(cls, message_id, delta):
+        """Atomically add to a message's like count."""
+
+        db.session.execute(cls.add_statement(
+            message_id, delta, db.session.get_bind().dialect))
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +217,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped whenever the profile is edited; cached pages and fragments
+    # that show this user are stamped with it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    # Denormalized counts, so profile pages don't load whole relationships
+    # just to count them. Kept up to date as rows are added and deleted (see
+    # "Counters" below); rebuild them with `flask reconcile-counters`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -119,16 +283,98 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
+
+        This is a primary-key lookup, so it doesn't depend on how many
+        followers there are.
+        """
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.get(Follows, (self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.get(Follows, (other_user.id, self.id)) is not None
+
+    def following_ids(self, among=None):
+        """Set of ids this user follows.
+
+        Pass `among` (e.g. the users on a page) to only check those, in one
+        IN query.
+        """
+
+        query = (db.session.query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.id))
+        if among is not None:
+            among = list(among)
+            if not among:
+                return set()
+            query = query.filter(Follows.user_being_followed_id.in_(among))
+
+        return {followed_id for (followed_id,) in query}
+
+    @classmethod
+    def bump(cls, user_ids, **deltas):
+        """Atomically add to counters, e.g. bump([1, 2], followers_count=1).
+
+        This is a single UPDATE ... SET n = n + delta, so concurrent requests
+        can't lose each other's changes.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+        if not user_ids:
+            return
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update({getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()},
+                 synchronize_session=False))
+
+    @classmethod
+    def reconcile_counters(cls, user_ids=None):
+        """Recount every counter from the base tables, in one UPDATE.
+
+        Pass user_ids to only recount those users.
+        """
+
+        def count(*criteria):
+            return (db.select(db.func.count())
+                    .where(*criteria)
+                    .scalar_subquery())
+
+        update = db.update(cls).values(
+            messages_count=count(Message.user_id == cls.id),
+            following_count=count(Follows.user_following_id == cls.id),
+            followers_count=count(Follows.user_being_followed_id == cls.id),
+            likes_count=count(Likes.user_id == cls.id),
+        )
+        if user_ids is not None:
+            update = update.where(cls.id.in_(user_ids))
+
+        db.session.execute(update, execution_options={
+            "synchronize_session": False})
+
+    def follow(self, other_user):
+        """Start following `other_user`. Returns False if already following."""
+
+        if db.session.get(Follows, (other_user.id, self.id)):
+            return False
+
+        db.session.add(Follows(user_being_followed_id=other_user.id,
+                               user_following_id=self.id))
+        return True
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`. Returns False if wasn't following."""
+
+        follow = db.session.get(Follows, (other_user.id, self.id))
+        if not follow:
+            return False
+
+        db.session.delete(follow)
+        return True
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +383,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             username=username,
@@ -158,13 +404,25 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the password was hashed with an old bcrypt cost, it's rehashed at
+        the current cost; commit the session to save it. When the password
+        pool is too busy for that, the old hash stays until a later login.
+
+        Raises PasswordPoolBusy if too many logins are already being checked.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_pool.check(user.password, password)
             if is_auth:
+                if password_pool.needs_rehash(user.password):
+                    try:
+                        user.password = password_pool.rehash(password)
+                    except PasswordPoolBusy:
+                        # the password checked out; don't fail the login
+                        pass
                 return user
 
         return False
@@ -188,7 +446,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +455,167 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized, like the counters on User, but spread over LikeCount
+    # rows and summed here
+    likes_count = db.column_property(
+        db.select(db.func.coalesce(db.func.sum(LikeCount.likes), 0))
+        .where(LikeCount.message_id == id)
+        .correlate_except(LikeCount)
+        .scalar_subquery())
+
     user = db.relationship('User')
 
+    @classmethod
+    def reconcile_counters(cls, message_ids=None):
+        """Recount likes from the likes table, into one LikeCount row per
+        liked message."""
+
+        counts = LikeCount.__table__
+        clear = db.delete(counts)
+        recount = (db.select(Likes.message_id, db.literal(0),
+                             db.func.count())
+                   .where(Likes.message_id.isnot(None))
+                   .group_by(Likes.message_id))
+        if message_ids is not None:
+            message_ids = list(message_ids)
+            clear = clear.where(counts.c.message_id.in_(message_ids))
+            recount = recount.where(Likes.message_id.in_(message_ids))
+
+        db.session.execute(clear)
+        db.session.execute(counts.insert().from_select(
+            ["message_id", "shard", "likes"], recount))
+
+
+##############################################################################
+# Secondary indexes for the hot query shapes. `flask migrate` adds any that
+# are missing from an existing database.
+
+# Profile feeds, and each followed user's slice of the home feed:
+#   WHERE user_id = ? ORDER BY timestamp DESC, id DESC
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+
+# Accounts big enough to be pulled rather than pushed (see timeline.py)
+db.Index('ix_users_followers_count', User.followers_count)
+
+# One like per user per message; also covers "everything a user has liked"
+db.Index('uq_likes_user_id_message_id',
+         Likes.user_id, Likes.message_id, unique=True)
+
+# Everyone who liked a message
+db.Index('ix_likes_message_id', Likes.message_id)
+
+# Substring search in the user directory: username ILIKE '%q%' (see
+# directory.py). Postgres only; on SQLite the directory keeps its own index.
+db.Index('ix_users_username_trgm', User.username,
+         postgresql_using='gin',
+         postgresql_ops={'username': 'gin_trgm_ops'},
+         ).ddl_if(dialect='postgresql')
+
+event.listen(User.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+             .execute_if(dialect='postgresql'))
+
+# The primary key covers (followed -> followers); this covers
+# (follower -> followed), which is what feeds and "following" pages use.
+db.Index('ix_follows_user_following_id',
+         Follows.user_following_id, Follows.user_being_followed_id)
+
+
+##############################################################################
+# Counters. Every Message, Follows and Likes row the ORM inserts or deletes
+# adjusts the counters it affects, in the same flush, with the same atomic
+# UPDATE ... SET n = n + delta as User.bump (a message's like count goes to
+# one of its LikeCount rows instead). That includes rows written
+# through the User.following, User.followers and User.likes collections.
+# Core and bulk statements (like Likes.toggle and the CSV loader) don't fire
+# these, and keep the counters right themselves.
+
+# model -> [(model holding the counter, counter, column with that row's id)]
+COUNTERS = {
+    Message: [(User, "messages_count", "user_id")],
+    Follows: [(User, "following_count", "user_following_id"),
+              (User, "followers_count", "user_being_followed_id")],
+    Likes: [(User, "likes_count", "user_id"),
+            (Message, "likes_count", "message_id")],
+}
+
+# collection -> (counter on its owner, counter on each item in it)
+COLLECTION_COUNTERS = {
+    "following": ("following_count", "followers_count"),
+    "followers": ("followers_count", "following_count"),
+    "likes": ("likes_count", "likes_count"),
+}
+
+
+def _add_to_counter(connection, model, counter, row_id, delta):
+    if model is Message:
+        # its one counter, likes_count, lives in LikeCount
+        connection.execute(
+            LikeCount.add_statement(row_id, delta, connection.dialect))
+        return
+
+    table = model.__table__
+    connection.execute(
+        db.update(table)
+        .where(table.c.id == row_id)
+        .values({counter: table.c[counter] + delta}))
+
+
+def _adjust_counters(delta):
+    def listener(mapper, connection, target):
+        for model, counter, key in COUNTERS[mapper.class_]:
+            _add_to_counter(connection, model, counter, getattr(target, key),
+                            delta)
+
+    return listener
+
+
+for model in COUNTERS:
+    event.listen(model, 'after_insert', _adjust_counters(1))
+    event.listen(model, 'after_delete', _adjust_counters(-1))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _count_collection_changes(session, flush_context):
+    """Appends to and removes from the many-to-many collections write the
+    follows/likes rows directly, with no Follows or Likes object for the
+    mapper events to see; count them from the collections' history."""
+
+    for owner in [*session.new, *session.dirty]:
+        if not isinstance(owner, User):
+            continue
+        attrs = db.inspect(owner).attrs
+        for name, (owner_counter, item_counter) in COLLECTION_COUNTERS.items():
+            history = attrs[name].history
+            for items, delta in ((history.added, 1), (history.deleted, -1)):
+                for item in items:
+                    connection = session.connection()
+                    _add_to_counter(connection, User, owner_counter, owner.id,
+                                    delta)
+                    _add_to_counter(connection, type(item), item_counter,
+                                    item.id, delta)
+
+
+@event.listens_for(Message, 'before_delete')
+def _unlike_deleted_message(mapper, connection, target):
+    """Its likes go with it (ON DELETE CASCADE), so its likers' counts drop.
+
+    Its LikeCount rows are deleted here too, since SQLite only cascades
+    when asked to, and would hand its id to the next message.
+    """
+
+    likes = Likes.__table__
+    users = User.__table__
+    connection.execute(
+        db.update(users)
+        .where(users.c.id.in_(db.select(likes.c.user_id)
+                              .where(likes.c.message_id == target.id)))
+        .values(likes_count=users.c.likes_count - 1))
+    connection.execute(
+        db.delete(LikeCount.__table__)
+        .where(LikeCount.__table__.c.message_id == target.id))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,92 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first by (Message.timestamp, Message.id). Instead of
+an OFFSET, each page carries an opaque cursor naming the last message shown;
+the next page asks for messages strictly older than it. That is a range scan
+on the (user_id, timestamp, id) index, so page 50 costs the same as page 1.
+"""
+
+import base64
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, request
+
+from models import db, Message
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def encode_cursor(timestamp, message_id):
+    """Make an opaque, URL-safe cursor for (timestamp, message_id)."""
+
+    raw = f"{timestamp.isoformat(timespec='microseconds')}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, message_id).
+
+    Raises ValueError if the cursor wasn't made by encode_cursor.
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, message_id = (
+            base64.urlsafe_b64decode(padded).decode().split("|"))
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (ValueError, TypeError) as err:
+        raise ValueError(f"Bad cursor: {cursor!r}") from err
+
+
+def cursor_from_request():
+    """The (timestamp, message_id) from ?before=..., or None for page one."""
+
+    cursor = request.args.get("before")
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def older_than(cursor):
+    """Filter clause for messages strictly older than the cursor."""
+
+    return db.tuple_(Message.timestamp, Message.id) < cursor
+
+
+def make_page(rows, limit, key=lambda row: (row.timestamp, row.id)):
+    """Build a Page from up to `limit + 1` newest-first rows.
+
+    The extra row only tells us whether there's a next page.
+    """
+
+    if len(rows) <= limit:
+        return Page(rows, None)
+
+    rows = rows[:limit]
+    return Page(rows, encode_cursor(*key(rows[-1])))
+
+
+def page_query(query, cursor, limit):
+    """Narrow a query over messages to one page (plus one row), newest
+    first."""
+
+    if cursor:
+        query = query.filter(older_than(cursor))
+
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit + 1))
+
+
+def paginate_messages(query, cursor, limit, wrap=list):
+    """Get one page of a message query, newest first.
+
+    `wrap` turns the result rows into the page's items (e.g. feed_items).
+    """
+
+    return make_page(wrap(page_query(query, cursor, limit)), limit)
@@ -0,0 +1,118 @@
+"""Password hashing on a small, bounded pool of threads.
+
+bcrypt is deliberately slow (about 250ms of CPU at cost 12). Run inline, a
+burst of logins ties up every request thread and the rest of the site stalls
+behind them. Instead, hashing and checking go through a fixed number of
+worker threads (bcrypt releases the GIL while it works) with a limit on how
+many requests may wait for one. Past that limit we raise PasswordPoolBusy
+straight away, and the route asks the user to try again.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+BCRYPT_COST = re.compile(r"^\$2[abxy]?\$(\d\d)\$")
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password operations are already running or waiting."""
+
+
+class PasswordPool:
+    """Run bcrypt hashing/checking on `workers` threads.
+
+    At most `workers + max_pending` operations may be in flight; more than
+    that raises PasswordPoolBusy without doing any work.
+    """
+
+    def __init__(self, workers=2, max_pending=8, rounds=12):
+        self._lock = threading.Lock()
+        self._latencies = {"hash": deque(maxlen=1000),
+                           "check": deque(maxlen=1000)}
+        self._counts = {"hash": 0, "check": 0, "rehash": 0, "rejected": 0}
+        self._executor = None
+        self.configure(workers, max_pending, rounds)
+
+    def configure(self, workers, max_pending, rounds):
+        """Change the pool size, queue limit and bcrypt cost."""
+
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+
+        old = self._executor
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(
+            self.workers + self.max_pending)
+        if old:
+            old.shutdown(wait=False)
+
+    def _run(self, kind, fn, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._counts["rejected"] += 1
+            raise PasswordPoolBusy()
+
+        start = time.perf_counter()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._counts[kind] += 1
+                self._latencies[kind].append(elapsed)
+
+    def hash(self, password):
+        """Hash a password at the configured cost."""
+
+        return self._run("hash", bcrypt.generate_password_hash,
+                         password, self.rounds).decode("UTF-8")
+
+    def check(self, pw_hash, password):
+        """Does this password match this hash?"""
+
+        return self._run("check", bcrypt.check_password_hash,
+                         pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was this hash made with a different cost than we use now?"""
+
+        match = BCRYPT_COST.match(pw_hash)
+        return not match or int(match.group(1)) != self.rounds
+
+    def rehash(self, password):
+        """Hash a password again after a cost change (counted separately)."""
+
+        with self._lock:
+            self._counts["rehash"] += 1
+        return self.hash(password)
+
+    def stats(self):
+        """Counts and latency percentiles (seconds, including queue wait)."""
+
+        with self._lock:
+            stats = {"workers": self.workers,
+                     "max_pending": self.max_pending,
+                     "rounds": self.rounds,
+                     **self._counts}
+            for kind, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                for pct in (50, 95, 99):
+                    stats[f"{kind}_p{pct}"] = (
+                        ordered[min(len(ordered) - 1,
+                                    len(ordered) * pct // 100)]
+                        if ordered else None)
+        return stats
+
+
+password_pool = PasswordPool()
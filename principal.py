@@ -0,0 +1,122 @@
+"""The logged-in user, as a small cached object.
+
+Every request needs a little about the logged-in user: their id, name and
+avatar for the navbar, their counters for the home page, and who they follow
+for the follow buttons. Rather than loading the full User row (and lazily
+loading relationships from templates) on every request, we keep a compact
+Principal per user in a per-worker cache for a few seconds.
+
+Routes that change the user's data invalidate their entry; changes made by
+other workers (or by other users, e.g. a new follower) show up once the
+entry expires.
+"""
+
+import threading
+import time
+
+from models import db, User, Follows
+
+
+class Principal:
+    """Read-only snapshot of the logged-in user."""
+
+    __slots__ = (
+        "id",
+        "username",
+        "image_url",
+        "header_image_url",
+        "version",
+        "messages_count",
+        "following_count",
+        "followers_count",
+        "likes_count",
+        "followed_ids",
+    )
+
+    def __init__(self, followed_ids, **fields):
+        self.followed_ids = frozenset(followed_ids)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"<Principal #{self.id}: {self.username}>"
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return other_user.id in self.followed_ids
+
+    def following_ids(self, among=None):
+        """Set of ids this user follows (optionally, only among these)."""
+
+        if among is None:
+            return set(self.followed_ids)
+        return self.followed_ids.intersection(among)
+
+
+def load_principal(user_id):
+    """Load a Principal from the database, or None if there's no such user."""
+
+    row = (db.session.query(User.id,
+                            User.username,
+                            User.image_url,
+                            User.header_image_url,
+                            User.version,
+                            User.messages_count,
+                            User.following_count,
+                            User.followers_count,
+                            User.likes_count)
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return None
+
+    followed_ids = (
+        followed_id for (followed_id,) in
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id))
+
+    return Principal(followed_ids, **row._asdict())
+
+
+class PrincipalCache:
+    """Per-worker cache of Principals, each kept for `ttl` seconds."""
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Get the Principal for this user, loading it if needed."""
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        principal = load_principal(user_id)
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._evict_expired(now)
+            self._entries[user_id] = (now + self.ttl, principal)
+        return principal
+
+    def invalidate(self, *user_ids):
+        """Forget these users; they'll be reloaded on their next request."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict_expired(self, now):
+        expired = [user_id for user_id, (expires, _) in self._entries.items()
+                   if expires <= now]
+        for user_id in expired or list(self._entries)[:len(self._entries) // 2]:
+            del self._entries[user_id]
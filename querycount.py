@@ -0,0 +1,42 @@
+"""Count the SQL statements a block of code sends to the database.
+
+    with count_queries() as counter:
+        client.get("/")
+    assert counter.count <= 10
+
+Used by tests to catch N+1 query patterns, and by the benchmarks to report
+queries per request.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """Tally of statements executed while it's listening."""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Count statements sent through `engine` (default: the app's) inside
+    the `with` block."""
+
+    engine = engine or db.engine
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
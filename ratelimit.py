@@ -0,0 +1,171 @@
+"""Token-bucket rate limiting for expensive endpoints.
+
+Each key (e.g. "login-ip:1.2.3.4") has a bucket holding up to `burst`
+tokens, refilled at `rate` tokens per second. Every attempt takes a token;
+an attempt that finds the bucket empty is rejected.
+
+Bucket state lives in a backend:
+
+- MemoryBackend keeps it in this process (each gunicorn worker counts on
+  its own, so the effective limit is multiplied by the number of workers)
+- SharedMemoryBackend keeps it in a memory-mapped file (e.g. under
+  /dev/shm) that every worker on the host shares
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_limit(limit):
+    """Turn "10/60" (10 attempts per 60 seconds) into (rate, burst)."""
+
+    count, seconds = limit.split("/")
+    return int(count) / float(seconds), int(count)
+
+
+def refill(tokens, updated, now, rate, burst):
+    """Bucket level at `now`, given its level at `updated`."""
+
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryBackend:
+    """Buckets in a dict in this process, least recently used evicted."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """Take a token from the bucket for `key`; False if it's empty."""
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, rate, burst)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedMemoryBackend:
+    """Buckets in a fixed-size, memory-mapped hash table shared by processes.
+
+    The table has `slots` slots of (key hash, tokens, updated). A key lives
+    in the first of a few slots after its hash that is free or already
+    holds it; if they're all taken by other keys, the oldest is reused.
+    Losing a bucket that way only ever makes us more lenient.
+
+    Access is serialized with an exclusive flock on the file.
+    """
+
+    SLOT = struct.Struct("<Qdd")
+    PROBES = 8
+
+    def __init__(self, path, slots=65536):
+        self.slots = slots
+        size = self.SLOT.size * slots
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _key_hash(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def take(self, key, rate, burst, now):
+        key_hash = self._key_hash(key)
+        start = key_hash % self.slots
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                slot = None
+                oldest = None
+                for probe in range(self.PROBES):
+                    index = (start + probe) % self.slots
+                    stored, tokens, updated = self.SLOT.unpack_from(
+                        self._map, index * self.SLOT.size)
+                    if stored == key_hash:
+                        slot = index
+                        break
+                    if stored == 0:
+                        slot, tokens, updated = index, burst, now
+                        break
+                    if oldest is None or updated < oldest[1]:
+                        oldest = (index, updated)
+
+                if slot is None:
+                    slot, tokens, updated = oldest[0], burst, now
+
+                tokens = refill(tokens, updated, now, rate, burst)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+
+                self.SLOT.pack_into(self._map, slot * self.SLOT.size,
+                                    key_hash, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def create_backend(uri):
+    """Make a rate limit backend from a URI.
+
+    - "memory://" keeps buckets in this process
+    - "shm:///dev/shm/warbler-ratelimit" shares them through that file
+    """
+
+    if uri == "memory://":
+        return MemoryBackend()
+
+    if uri.startswith("shm://"):
+        return SharedMemoryBackend(uri[len("shm://"):])
+
+    raise ValueError(f"Unknown rate limit backend: {uri}")
+
+
+class RateLimiter:
+    """A named limit, e.g. RateLimiter(backend, "login-ip", "10/60")."""
+
+    def __init__(self, backend, name, limit):
+        self.backend = backend
+        self.name = name
+        self.rate, self.burst = parse_limit(limit)
+
+    def allow(self, key):
+        """Take a token for `key`; False if it's over the limit."""
+
+        return self.backend.take(f"{self.name}:{key}", self.rate, self.burst,
+                                 time.time())
@@ -0,0 +1,84 @@
+"""Fingerprinted asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, assets
+from assets import build_assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted static files."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.static_dir = os.path.join(self.tmp.name, "static")
+        self.out_dir = os.path.join(self.static_dir, "dist")
+
+        os.makedirs(os.path.join(self.static_dir, "images"))
+        with open(os.path.join(self.static_dir, "images", "logo.png"),
+                  "wb") as f:
+            f.write(b"not really a png")
+        with open(os.path.join(self.static_dir, "style.css"), "w") as f:
+            f.write('body { background: url("/static/images/logo.png"); }\n'
+                    * 20)
+
+        self.old_dir = assets.out_dir
+
+    def tearDown(self):
+        assets.load(self.old_dir)
+        self.tmp.cleanup()
+
+    def test_build(self):
+        """Files get content-hashed names; CSS points at hashed images."""
+        manifest = build_assets(self.static_dir, self.out_dir)
+
+        self.assertEqual(set(manifest), {"images/logo.png", "style.css"})
+        self.assertRegex(manifest["style.css"], r"^style\.[0-9a-f]{12}\.css$")
+
+        with open(os.path.join(self.out_dir, manifest["style.css"])) as f:
+            css = f.read()
+        self.assertIn(f'url("/assets/{manifest["images/logo.png"]}")', css)
+        self.assertNotIn("/static/", css)
+
+        # only compressible files get a .gz variant
+        gz = os.path.join(self.out_dir, manifest["style.css"] + ".gz")
+        with open(gz, "rb") as f:
+            self.assertEqual(gzip.decompress(f.read()).decode(), css)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.out_dir, manifest["images/logo.png"] + ".gz")))
+
+        # building again gives the same names
+        self.assertEqual(build_assets(self.static_dir, self.out_dir), manifest)
+
+    def test_serve(self):
+        """Fingerprinted URLs are immutable and served precompressed."""
+        manifest = build_assets(self.static_dir, self.out_dir)
+        assets.load(self.out_dir)
+
+        url = assets.url("style.css")
+        self.assertEqual(url, f"/assets/{manifest['style.css']}")
+        self.assertEqual(assets.url("missing.js"), "/static/missing.js")
+
+        client = app.test_client()
+        resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        plain = gzip.decompress(resp.get_data())
+
+        resp = client.get(url)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_data(), plain)
+
+        self.assertEqual(client.get("/assets/style.css").status_code, 404)
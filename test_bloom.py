@@ -0,0 +1,32 @@
+"""Bloom filter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bloom.py
+
+from unittest import TestCase
+
+from bloom import BloomFilter
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter."""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+        self.assertFalse(bloom.full)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+        bloom.add("one too many")
+        self.assertTrue(bloom.full)
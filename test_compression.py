@@ -0,0 +1,85 @@
+"""Compression middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+import gzip
+from unittest import TestCase
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from compression import CompressionMiddleware
+
+PAGE = "<p>" + "warble " * 200 + "</p>"
+
+
+def make_app(body, mimetype="text/html", **headers):
+    def app(environ, start_response):
+        return Response(body, mimetype=mimetype,
+                        headers=headers)(environ, start_response)
+    return app
+
+
+class CompressionMiddlewareTestCase(TestCase):
+    """Test which responses get compressed, and how."""
+
+    def get(self, app, accept="gzip, deflate"):
+        middleware = CompressionMiddleware(app, min_size=500)
+        resp = Client(middleware).get("/", headers={"Accept-Encoding": accept})
+        return middleware, resp
+
+    def test_compresses_html(self):
+        middleware, resp = self.get(make_app(PAGE, ETag='"abc"'))
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(resp.headers["ETag"], 'W/"abc"')
+        self.assertNotIn("Content-Length", resp.headers)
+        self.assertEqual(gzip.decompress(resp.get_data()).decode(), PAGE)
+
+        stats = middleware.stats()
+        self.assertEqual(stats["compressed"], 1)
+        self.assertEqual(stats["bytes_in"], len(PAGE))
+        self.assertEqual(stats["bytes_out"], len(resp.get_data()))
+        self.assertLess(stats["ratio"], 0.5)
+
+    def test_streams_chunks(self):
+        """A body of unknown length is compressed as it's produced."""
+        produced = []
+
+        def chunks():
+            for i in range(100):
+                produced.append(i)
+                yield f"<li>item {i}</li>"
+
+        middleware = CompressionMiddleware(make_app(chunks()), min_size=500)
+        body = Client(middleware).get(
+            "/", headers={"Accept-Encoding": "gzip"}, buffered=False)
+        self.assertEqual(body.headers["Content-Encoding"], "gzip")
+        # only enough was read to pass the size threshold
+        self.assertLess(len(produced), 100)
+
+        data = b"".join(body.response)
+        self.assertEqual(len(produced), 100)
+        self.assertEqual(gzip.decompress(data).decode(),
+                         "".join(f"<li>item {i}</li>" for i in range(100)))
+
+    def test_skips(self):
+        """Small bodies, other types, encoded bodies and clients that don't
+        accept gzip are left alone."""
+        cases = [
+            (make_app("<p>short</p>"), "gzip"),
+            (make_app(PAGE, mimetype="text/css"), "gzip"),
+            (make_app(PAGE, **{"Content-Encoding": "br"}), "gzip, br"),
+            (make_app(PAGE), "identity"),
+        ]
+        for app, accept in cases:
+            _, resp = self.get(app, accept)
+            self.assertNotEqual(resp.headers.get("Content-Encoding"), "gzip")
+            self.assertNotEqual(resp.get_data()[:2], b"\x1f\x8b")
+
+        _, resp = self.get(make_app(PAGE), "identity")
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(resp.get_data(as_text=True), PAGE)
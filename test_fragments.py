@@ -0,0 +1,45 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+from unittest import TestCase
+
+from fragments import FragmentCache
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the LRU fragment cache."""
+
+    def test_version_mismatch_is_a_miss(self):
+        cache = FragmentCache()
+        cache.put(1, 1, "<p>v1</p>")
+
+        self.assertEqual(cache.get(1, 1), "<p>v1</p>")
+        self.assertIsNone(cache.get(1, 2))
+
+        html = cache.render(1, 2, lambda: "<p>v2</p>")
+        self.assertEqual(html, "<p>v2</p>")
+        self.assertEqual(cache.get(1, 2), "<p>v2</p>")
+
+    def test_memory_budget(self):
+        """Least recently used entries go first once over budget."""
+        cache = FragmentCache(max_bytes=20)
+        cache.put(1, 1, "a" * 8)
+        cache.put(2, 1, "b" * 8)
+        cache.get(1, 1)
+        cache.put(3, 1, "c" * 8)
+
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual(cache.get(1, 1), "a" * 8)
+        self.assertEqual(cache.get(3, 1), "c" * 8)
+        self.assertLessEqual(cache.stats()["bytes"], 20)
+
+    def test_evict(self):
+        cache = FragmentCache()
+        cache.put(1, 1, "<p>gone</p>")
+        cache.evict(1)
+
+        self.assertIsNone(cache.get(1, 1))
+        self.assertEqual(cache.stats()["bytes"], 0)
@@ -0,0 +1,108 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from loader import load_csvs
+from models import db, User, Message, Follows
+
+CSVS = {
+    "users.csv": [
+        "email,username,image_url,password,bio,header_image_url,location",
+        "a@test.com,alice,,hash,\"Hi, I'm Alice\",,Paris",
+        "b@test.com,bob,,hash,,,",
+        "c@test.com,carol,,hash,\"two\nlines\",,",
+    ],
+    "messages.csv": [
+        "text,timestamp,user_id",
+        "first,2020-01-01 10:00:00.000000,1",
+        "second,2020-01-02 10:00:00.000000,1",
+        "third,2020-01-03 10:00:00.000000,2",
+    ],
+    "follows.csv": [
+        "user_being_followed_id,user_following_id",
+        "1,2",
+        "1,3",
+        "2,1",
+    ],
+}
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSVs in chunks."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for filename, lines in CSVS.items():
+            with open(os.path.join(self.tmp.name, filename), "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+    def test_load(self):
+        log = []
+        loaded = load_csvs(self.tmp.name, chunk_rows=2, echo=log.append)
+
+        self.assertEqual({name: rows for name, (rows, _) in loaded.items()},
+                         {"users": 3, "messages": 3, "follows": 3})
+        self.assertTrue(any("rows/s" in line for line in log))
+
+        alice, bob, carol = User.query.order_by(User.id).all()
+        self.assertEqual(alice.bio, "Hi, I'm Alice")
+        self.assertEqual(carol.bio, "two\nlines")
+        self.assertIsNone(bob.bio)
+
+        # counters are filled in after the load
+        self.assertEqual((alice.messages_count, alice.followers_count,
+                          alice.following_count), (2, 2, 1))
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 3)
+
+        # indexes dropped for the load are back
+        indexes = {ix["name"] for ix in db.inspect(db.engine)
+                   .get_indexes("messages")}
+        self.assertIn("ix_messages_user_id_timestamp", indexes)
+
+    def test_load_shards(self):
+        # split messages over two files with explicit ids, listed in a
+        # manifest; the manifest decides what gets loaded
+        shards = {
+            "messages.0000.csv": ["id,text,timestamp,user_id",
+                                  "10,ten,2020-01-01 10:00:00.000000,2"],
+            "messages.0001.csv": ["id,text,timestamp,user_id",
+                                  "20,twenty,2020-01-02 10:00:00.000000,3",
+                                  "21,more,2020-01-03 10:00:00.000000,3"],
+        }
+        for filename, lines in shards.items():
+            with open(os.path.join(self.tmp.name, filename), "w") as f:
+                f.write("\n".join(lines) + "\n")
+        with open(os.path.join(self.tmp.name, "manifest.json"), "w") as f:
+            json.dump({"shards": [
+                {"table": "users", "file": "users.csv", "rows": 3},
+                {"table": "messages", "file": "messages.0000.csv",
+                 "rows": 1},
+                {"table": "messages", "file": "messages.0001.csv",
+                 "rows": 2},
+            ]}, f)
+
+        loaded = load_csvs(self.tmp.name, workers=2, echo=lambda line: None)
+
+        self.assertEqual({name: rows for name, (rows, _) in loaded.items()},
+                         {"users": 3, "messages": 3})
+        self.assertEqual(
+            [(m.id, m.text) for m in Message.query.order_by(Message.id)],
+            [(10, "ten"), (20, "twenty"), (21, "more")])
+        self.assertEqual(db.session.get(User, 3).messages_count, 2)
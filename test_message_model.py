@@ -5,10 +5,11 @@
 #    python -m unittest test_message_model.py
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, Message, User
+from models import db, Message, User, Likes, LikeCount
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,6 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 
 from app import app
+from migrations import migrate, check_query_plans, full_scans
 db.create_all()
 
 class UserModelTestCase(TestCase):
@@ -60,6 +62,61 @@ class UserModelTestCase(TestCase):
         self.assertEqual(m.text, 'test')
         self.assertEqual(len(first_user.messages),1)
 
+    def test_like_count_spread_over_rows(self):
+        """Likes of one message land on several LikeCount rows, and
+        likes_count adds them up."""
+        author = User(email="test11@test.com", username="testuser11",
+                      password="HASHED_PASSWORD")
+        fans = [User(email=f"fan{i}@test.com", username=f"fan{i}",
+                     password="HASHED_PASSWORD") for i in range(30)]
+        db.session.add_all([author, *fans])
+        db.session.commit()
+        msg = Message(text="popular", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        for fan in fans:
+            Likes.toggle(fan.id, msg.id)
+        Likes.toggle(fans[0].id, msg.id)
+        db.session.commit()
+
+        shards = LikeCount.query.filter_by(message_id=msg.id).count()
+        self.assertGreater(shards, 1)
+        self.assertEqual(msg.likes_count, 29)
+
+        # a recount folds them back into one row
+        Message.reconcile_counters([msg.id])
+        db.session.commit()
+        self.assertEqual(LikeCount.query.filter_by(message_id=msg.id).count(),
+                         1)
+        self.assertEqual(msg.likes_count, 29)
+
+        db.session.delete(msg)
+        db.session.commit()
+        self.assertEqual(LikeCount.query.count(), 0)
+
+    def test_message_timestamps_are_per_message(self):
+        """Each message is stamped when it's created, not when models.py
+        was imported."""
+        first_user= User(
+            email="test11@test.com",
+            username="testuser11",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add(first_user)
+        db.session.commit()
+
+        before = datetime.utcnow()
+        m1 = Message(text='first', user_id=first_user.id)
+        db.session.add(m1)
+        db.session.commit()
+        m2 = Message(text='second', user_id=first_user.id)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertGreaterEqual(m1.timestamp, before)
+        self.assertGreater(m2.timestamp, m1.timestamp)
+
     def test_message_missing_text(self):
         """Does the Message model fail without valid text?"""
         first_user= User(
@@ -94,4 +151,38 @@ class UserModelTestCase(TestCase):
         m = Message(text = 'test', user_id = 321)
         with self.assertRaises(exc.SQLAlchemyError) as context:
             db.session.add(m)
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+    def test_migrate_adds_missing_indexes(self):
+        """migrate() recreates a missing index and is a no-op afterwards."""
+        db.session.execute(db.text("DROP INDEX ix_messages_user_id_timestamp"))
+        db.session.commit()
+
+        self.assertEqual(migrate(), ["index ix_messages_user_id_timestamp"])
+        self.assertEqual(migrate(), [])
+
+    def test_feed_queries_use_indexes(self):
+        """No feed route's main query scans the whole messages table."""
+        self.assertEqual(check_query_plans(), {})
+
+    def test_full_index_scan_counts_as_full_scan(self):
+        """An index scan over messages with no Index Cond reads the whole
+        table, like a sequential scan does."""
+        def plan(scan):
+            return {"Node Type": "Limit", "Plans": [
+                dict(scan, **{"Relation Name": "messages"})]}
+
+        _, scans = full_scans(plan({"Node Type": "Seq Scan"}))
+        self.assertTrue(scans)
+
+        lines, scans = full_scans(plan({"Node Type": "Index Scan",
+                                        "Index Name": "messages_pkey"}))
+        self.assertTrue(scans)
+        self.assertEqual(lines, ["Limit", "  Index Scan using messages_pkey "
+                                          "on messages"])
+
+        _, scans = full_scans(plan({
+            "Node Type": "Index Scan",
+            "Index Name": "ix_messages_user_id_timestamp",
+            "Index Cond": "(user_id = 1)"}))
+        self.assertFalse(scans)
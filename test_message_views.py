@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, Likes, LikeCount
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +20,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import (app, CURR_USER_KEY, timelines, principals, fragments,
+                 directory)
+from querycount import count_queries
+import timeline
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +44,13 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        LikeCount.query.delete()
+        timelines.clear()
+        principals.clear()
+        fragments.clear()
+        directory.clear()
 
         self.client = app.test_client()
 
@@ -56,6 +66,9 @@ class MessageViewTestCase(TestCase):
         db.session.rollback()
         User.query.delete()
         Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        LikeCount.query.delete()
         db.session.commit()
 
     def test_add_message(self):
@@ -78,6 +91,7 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
 
     def test_delete_message(self):
         """Can user delete a message?"""
@@ -158,3 +172,161 @@ class MessageViewTestCase(TestCase):
 
             m = Message.query.get(1234)
             self.assertIsNotNone(m)
+
+    def test_message_pushed_to_follower_feed(self):
+        """A new message shows up in followers' home feeds, and leaves
+        them again when it is deleted."""
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        db.session.commit()
+        follower.follow(self.testuser)
+        db.session.commit()
+        follower_id = follower.id
+
+        with self.client as c:
+            # build the follower's timeline before the message is posted
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+            c.get("/")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/messages/new", data={"text": "Pushed to you"})
+            msg_id = Message.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+            resp = c.get("/")
+            self.assertIn("Pushed to you", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post(f"/messages/{msg_id}/delete")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+            resp = c.get("/")
+            self.assertNotIn("Pushed to you", resp.get_data(as_text=True))
+
+    def test_high_follower_account_is_pulled(self):
+        """Messages from accounts over the pull threshold aren't pushed,
+        but are merged into followers' feeds when they read them."""
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        db.session.commit()
+        follower.follow(self.testuser)
+        db.session.commit()
+        follower_id = follower.id
+
+        app.config['FEED_PULL_THRESHOLD'] = 0
+        timeline._pulled_cache.clear()
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+                c.get("/")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                c.post("/messages/new", data={"text": "Pulled for you"})
+
+                # it wasn't pushed to the follower...
+                self.assertEqual(timelines.get(follower_id, 100), [])
+
+                # ...but they see it anyway
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+                resp = c.get("/")
+                self.assertIn("Pulled for you", resp.get_data(as_text=True))
+        finally:
+            app.config['FEED_PULL_THRESHOLD'] = 10000
+            timeline._pulled_cache.clear()
+
+    def test_like_toggle_per_user(self):
+        """Different users can like the same message; liking again unlikes
+        only your own like."""
+        other = User.signup("other", "other@test.com", "password", None)
+        msg = Message(text="likeable", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        other_id, msg_id = other.id, msg.id
+
+        with self.client as c:
+            for user_id in (self.testuser.id, other_id):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/users/add_like/{msg_id}")
+
+            self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 2)
+            self.assertEqual(Message.query.get(msg_id).likes_count, 2)
+
+            # other unlikes; testuser's like stays
+            c.post(f"/users/add_like/{msg_id}")
+            likes = Likes.query.filter_by(message_id=msg_id).all()
+            self.assertEqual([like.user_id for like in likes], [self.testuser.id])
+            self.assertEqual(Message.query.get(msg_id).likes_count, 1)
+            self.assertEqual(User.query.get(other_id).likes_count, 0)
+            self.assertEqual(User.query.get(self.testuser.id).likes_count, 1)
+
+            # like state is per viewer, counts are shared
+            self.assertEqual(Likes.state_for(self.testuser.id, [msg_id]),
+                             ({msg_id}, {msg_id: 1}))
+            self.assertEqual(Likes.state_for(other_id, [msg_id]),
+                             (set(), {msg_id: 1}))
+
+    def test_feed_query_counts(self):
+        """Feed pages don't issue a query per message (N+1)."""
+        authors = [User.signup(f"author{i}", f"author{i}@test.com",
+                               "password", None) for i in range(5)]
+        db.session.commit()
+        viewer = User.query.get(self.testuser.id)
+        for author in authors:
+            viewer.follow(author)
+        messages = [Message(text=f"msg {i}", user_id=authors[i % 5].id)
+                    for i in range(30)]
+        db.session.add_all(messages)
+        db.session.commit()
+        for msg in messages[::3]:
+            Likes.toggle(viewer.id, msg.id)
+        db.session.commit()
+        viewer_id = viewer.id
+        db.session.expire_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer_id
+
+            for url in ["/", f"/users/{authors[0].id}",
+                        f"/users/{viewer_id}/likes"]:
+                principals.clear()
+                with count_queries() as counter:
+                    resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(counter.count, 8, url)
+
+    def test_show_message_revalidates(self):
+        """The message page answers If-None-Match with a 304."""
+        msg = Message(text="cache me", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+            etag = resp.headers["ETag"]
+
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            # logged in, the page (navbar, buttons) is someone's own
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            self.assertEqual(c.get("/messages/0").status_code, 404)
@@ -0,0 +1,59 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from ratelimit import MemoryBackend, SharedMemoryBackend, parse_limit
+
+
+class BackendTestCase(TestCase):
+    """Test the in-process backend (SharedMemoryBackendTestCase runs the
+    same tests against the shared one)."""
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.rate, self.burst = parse_limit("3/60")
+
+    def take(self, key, now):
+        return self.backend.take(key, self.rate, self.burst, now)
+
+    def test_burst_then_reject(self):
+        self.assertEqual([self.take("a", 0) for _ in range(4)],
+                         [True, True, True, False])
+
+        # other keys have their own bucket
+        self.assertTrue(self.take("b", 0))
+
+    def test_refill(self):
+        for _ in range(3):
+            self.take("a", 0)
+        self.assertFalse(self.take("a", 10))
+
+        # one token every 20 seconds
+        self.assertTrue(self.take("a", 21))
+        self.assertFalse(self.take("a", 22))
+
+
+class SharedMemoryBackendTestCase(BackendTestCase):
+    """Test the backend shared between processes through a file."""
+
+    def setUp(self):
+        super().setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.backend = SharedMemoryBackend(self.path, slots=64)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_shared_between_instances(self):
+        """Two mappings of the same file (e.g. two workers) share buckets."""
+        other = SharedMemoryBackend(self.path, slots=64)
+        for _ in range(3):
+            self.assertTrue(self.take("a", 0))
+        self.assertFalse(other.take("a", self.rate, self.burst, 0))
@@ -0,0 +1,105 @@
+"""Timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from timeline import MemoryTimelineStore, SQLiteTimelineStore, merge_streams
+
+
+class TimelineStoreTestCase(TestCase):
+    """Test the in-process timeline store (SQLiteTimelineStoreTestCase
+    runs the same tests against the SQLite one)."""
+
+    def setUp(self):
+        self.store = MemoryTimelineStore(max_length=3)
+        self.t0 = datetime(2024, 1, 1)
+
+    def at(self, minutes):
+        return self.t0 + timedelta(minutes=minutes)
+
+    def test_unbuilt_timeline(self):
+        """Timelines that were never built read as None, and pushes skip them."""
+        self.store.push([1], self.at(1), 10)
+        self.assertIsNone(self.store.get(1, 100))
+
+    def test_push_keeps_newest_first(self):
+        self.store.put(1, [(self.at(5), 50), (self.at(1), 10)])
+        self.store.push([1], self.at(3), 30)
+
+        self.assertEqual(self.store.get(1, 100),
+                         [(self.at(5), 50), (self.at(3), 30), (self.at(1), 10)])
+        self.assertEqual(self.store.get(1, 1), [(self.at(5), 50)])
+
+    def test_timeline_is_bounded(self):
+        self.store.put(1, [(self.at(i), i) for i in range(3)])
+        self.store.push([1], self.at(9), 9)
+
+        self.assertEqual([mid for _, mid in self.store.get(1, 100)], [9, 2, 1])
+
+    def test_get_before_cursor(self):
+        self.store.put(1, [(self.at(i), i) for i in range(3)])
+
+        self.assertEqual([mid for _, mid in self.store.get(1, 1, (self.at(2), 2))],
+                         [1])
+        self.assertEqual(self.store.get(1, 100, (self.at(0), 0)), [])
+
+    def test_remove_and_drop(self):
+        self.store.put(1, [(self.at(1), 10), (self.at(2), 20)])
+        self.store.put(2, [(self.at(1), 10)])
+
+        self.store.remove([1, 2], 10)
+        self.assertEqual(self.store.get(1, 100), [(self.at(2), 20)])
+        self.assertEqual(self.store.get(2, 100), [])
+
+        self.store.drop([1])
+        self.assertIsNone(self.store.get(1, 100))
+
+
+class MemoryTimelineStoreLimitsTestCase(TestCase):
+    """The in-process store expires and evicts timelines."""
+
+    def test_timelines_expire(self):
+        store = MemoryTimelineStore(ttl=0)
+        store.put(1, [(datetime(2024, 1, 1), 10)])
+        time.sleep(0.01)
+        self.assertIsNone(store.get(1, 100))
+
+    def test_least_recently_read_evicted(self):
+        store = MemoryTimelineStore(max_users=2)
+        entries = [(datetime(2024, 1, 1), 10)]
+        store.put(1, entries)
+        store.put(2, entries)
+        store.get(1, 100)
+        store.put(3, entries)
+
+        self.assertIsNone(store.get(2, 100))
+        self.assertEqual(store.get(1, 100), entries)
+        self.assertEqual(store.get(3, 100), entries)
+
+
+class SQLiteTimelineStoreTestCase(TimelineStoreTestCase):
+    """Test the SQLite timeline store."""
+
+    def setUp(self):
+        super().setUp()
+        self.store = SQLiteTimelineStore(":memory:", max_length=3)
+
+
+class MergeStreamsTestCase(TestCase):
+    """Test the k-way merge used for hybrid push/pull feeds."""
+
+    def test_merge_streams(self):
+        t0 = datetime(2024, 1, 1)
+        pushed = [(t0 + timedelta(minutes=m), m) for m in (9, 5, 1)]
+        pulled_a = [(t0 + timedelta(minutes=m), m) for m in (8, 5, 2)]
+        pulled_b = [(t0 + timedelta(minutes=m), m) for m in (7, 3)]
+
+        merged = merge_streams([pushed, pulled_a, pulled_b], 5)
+
+        # newest first, duplicate message 5 only kept once
+        self.assertEqual([mid for _, mid in merged], [9, 8, 7, 5, 3])
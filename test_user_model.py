@@ -9,7 +9,7 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from passwords import password_pool
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -229,4 +230,163 @@ class UserModelTestCase(TestCase):
         # wrong username
         self.assertFalse(User.authenticate('test2', password))
         # wrong password
-        self.assertFalse(User.authenticate(username, 'wrongpassword'))
\ No newline at end of file
+        self.assertFalse(User.authenticate(username, 'wrongpassword'))
+
+    def test_counters(self):
+        """follow/unfollow keep the counters in step, and reconcile_counters
+        rebuilds them from the base tables."""
+        first_user= User(
+            email="test11@test.com",
+            username="testuser11",
+            password="HASHED_PASSWORD"
+        )
+        second_user= User(
+            email="test22@test.com",
+            username="testuser22",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add_all([first_user, second_user])
+        db.session.commit()
+
+        self.assertTrue(first_user.follow(second_user))
+        self.assertFalse(first_user.follow(second_user))
+        db.session.commit()
+        self.assertEqual(first_user.following_count, 1)
+        self.assertEqual(second_user.followers_count, 1)
+
+        # counters that drifted get rebuilt
+        db.session.add(Message(text="hi", user_id=second_user.id))
+        User.bump(second_user.id, followers_count=5)
+        db.session.commit()
+        User.reconcile_counters()
+        db.session.commit()
+        self.assertEqual(second_user.followers_count, 1)
+        self.assertEqual(second_user.messages_count, 1)
+
+        self.assertTrue(first_user.unfollow(second_user))
+        db.session.commit()
+        self.assertEqual(first_user.following_count, 0)
+        self.assertEqual(second_user.followers_count, 0)
+
+    def test_counters_follow_orm_rows(self):
+        """Rows added or deleted straight through the ORM keep the counters
+        right, without going through follow() or a route."""
+        first_user = User(email="test11@test.com", username="testuser11",
+                          password="HASHED_PASSWORD")
+        second_user = User(email="test22@test.com", username="testuser22",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([first_user, second_user])
+        db.session.commit()
+
+        msg = Message(text="hi", user_id=second_user.id)
+        db.session.add_all([
+            msg,
+            Follows(user_being_followed_id=second_user.id,
+                    user_following_id=first_user.id),
+        ])
+        db.session.commit()
+        like = Likes(user_id=first_user.id, message_id=msg.id)
+        db.session.add(like)
+        db.session.commit()
+
+        self.assertEqual((second_user.messages_count,
+                          second_user.followers_count), (1, 1))
+        self.assertEqual((first_user.following_count,
+                          first_user.likes_count), (1, 1))
+        self.assertEqual(msg.likes_count, 1)
+
+        # deleting the message takes its like with it
+        db.session.delete(msg)
+        db.session.commit()
+        self.assertEqual(second_user.messages_count, 0)
+        self.assertEqual(first_user.likes_count, 0)
+
+    def test_counters_follow_collections(self):
+        """Appending to or removing from the follow and like collections
+        keeps the counters right too."""
+        first_user = User(email="test11@test.com", username="testuser11",
+                          password="HASHED_PASSWORD")
+        second_user = User(email="test22@test.com", username="testuser22",
+                           password="HASHED_PASSWORD")
+        third_user = User(email="test33@test.com", username="testuser33",
+                          password="HASHED_PASSWORD")
+        db.session.add_all([first_user, second_user, third_user])
+        db.session.commit()
+        msg = Message(text="hi", user_id=second_user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        first_user.following.append(second_user)
+        second_user.followers.append(third_user)
+        first_user.likes.append(msg)
+        db.session.commit()
+        self.assertEqual((first_user.following_count,
+                          first_user.likes_count), (1, 1))
+        self.assertEqual(second_user.followers_count, 2)
+        self.assertEqual(third_user.following_count, 1)
+        self.assertEqual(msg.likes_count, 1)
+
+        first_user.following.remove(second_user)
+        first_user.likes.remove(msg)
+        db.session.commit()
+        self.assertEqual((first_user.following_count,
+                          first_user.likes_count), (0, 0))
+        self.assertEqual(second_user.followers_count, 1)
+        self.assertEqual(msg.likes_count, 0)
+
+    def test_rehash_on_login(self):
+        """A password hashed at an old bcrypt cost is rehashed on login."""
+        rounds = password_pool.rounds
+        try:
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, 4)
+            user = User.signup("rehash", "rehash@test.com", "secret123", None)
+            db.session.commit()
+            self.assertTrue(user.password.startswith("$2b$04$"))
+
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, 5)
+            self.assertTrue(User.authenticate("rehash", "secret123"))
+            db.session.commit()
+            self.assertTrue(user.password.startswith("$2b$05$"))
+            self.assertTrue(User.authenticate("rehash", "secret123"))
+        finally:
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, rounds)
+
+    def test_rehash_skipped_when_pool_busy(self):
+        """A login whose password checked out isn't failed because the pool
+        filled up before the rehash; the old hash is kept."""
+        rounds = password_pool.rounds
+        try:
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, 4)
+            user = User.signup("rehash", "rehash@test.com", "secret123", None)
+            db.session.commit()
+            old_hash = user.password
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, 5)
+
+            slots = password_pool.workers + password_pool.max_pending
+            check = password_pool.check
+
+            def check_then_fill_pool(*args):
+                result = check(*args)
+                for _ in range(slots):
+                    password_pool._slots.acquire()
+                return result
+
+            password_pool.check = check_then_fill_pool
+            try:
+                self.assertEqual(User.authenticate("rehash", "secret123"),
+                                 user)
+            finally:
+                del password_pool.check
+                for _ in range(slots):
+                    password_pool._slots.release()
+
+            db.session.commit()
+            self.assertEqual(user.password, old_hash)
+        finally:
+            password_pool.configure(password_pool.workers,
+                                    password_pool.max_pending, rounds)
@@ -6,6 +6,8 @@
 
 
 import os
+import re
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 from models import db, connect_db, Message, User, Likes, Follows
@@ -17,7 +19,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, timelines, principals, fragments, directory, ratelimit_backend
+from directory import decode_cursor
+from passwords import password_pool
 
 db.create_all()
 
@@ -32,6 +36,11 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        timelines.clear()
+        principals.clear()
+        fragments.clear()
+        directory.clear()
+        ratelimit_backend.clear()
 
         self.client = app.test_client()
 
@@ -203,3 +212,386 @@ class MessageViewTestCase(TestCase):
             self.assertIn(f'@{self.u2.username}',html)
             self.assertIn(f'@{self.u3.username}',html)
             self.assertIn(f'@{self.u4.username}',html)
+
+    def test_profile_pagination(self):
+        """Profiles show 100 messages and a cursor link to the rest."""
+        start = datetime(2024, 1, 1)
+        db.session.add_all([
+            Message(text=f"msg-{i}-end", user_id=self.testuser_id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(105)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser_id}')
+            html = resp.get_data(as_text=True)
+            self.assertIn('msg-104-end', html)
+            self.assertIn('msg-5-end', html)
+            self.assertNotIn('msg-4-end', html)
+
+            next_url = re.search(r'href="(\?before=[^"]+)"', html).group(1)
+
+            resp2 = c.get(f'/users/{self.testuser_id}{next_url}')
+            html2 = resp2.get_data(as_text=True)
+            self.assertIn('msg-4-end', html2)
+            self.assertIn('msg-0-end', html2)
+            self.assertNotIn('msg-5-end', html2)
+            self.assertNotIn('id="load-more"', html2)
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser_id}?before=not-a-cursor')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_users_index_follow_buttons(self):
+        """The directory shows Unfollow only for users we follow."""
+        follow = Follows(user_being_followed_id=self.u1_id, user_following_id=self.testuser_id)
+        db.session.add(follow)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            html = c.get("/users").get_data(as_text=True)
+
+            self.assertIn(f'action="/users/stop-following/{self.u1_id}"', html)
+            self.assertIn(f'action="/users/follow/{self.u2_id}"', html)
+            self.assertNotIn(f'action="/users/stop-following/{self.u2_id}"', html)
+
+    def test_follow_refreshes_cached_user(self):
+        """Following someone shows up straight away, even though the
+        logged-in user is cached between requests."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn(f'action="/users/follow/{self.u1_id}"', html)
+
+            c.post(f"/users/follow/{self.u1_id}")
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.u1_id}"', html)
+            self.assertEqual(principals.get(self.testuser_id).following_count, 1)
+
+    def test_current_user_row_not_shared_between_requests(self):
+        """One user's request doesn't act on the row the last one loaded."""
+        alice = app.test_client()
+        bob = app.test_client()
+        with alice.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+        with bob.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        self.assertEqual(alice.get("/users/profile").status_code, 200)
+        self.assertEqual(bob.post("/users/delete").status_code, 302)
+
+        db.session.expire_all()
+        self.assertIsNotNone(db.session.get(User, self.u1_id))
+        self.assertIsNone(db.session.get(User, self.u2_id))
+
+    def test_login_when_password_pool_busy(self):
+        """Logins are turned away quickly when bcrypt is saturated."""
+        # take every slot in the pool
+        slots = password_pool.workers + password_pool.max_pending
+        for _ in range(slots):
+            password_pool._slots.acquire()
+        try:
+            with self.client as c:
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "testuser"})
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn("try again", resp.get_data(as_text=True))
+        finally:
+            for _ in range(slots):
+                password_pool._slots.release()
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_login_rate_limited(self):
+        """Repeated logins for one username are rejected before bcrypt."""
+        with self.client as c:
+            for _ in range(5):
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "wrong-password"})
+                self.assertEqual(resp.status_code, 200)
+
+            checks = password_pool.stats()["check"]
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "testuser"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(password_pool.stats()["check"], checks)
+
+    def test_profile_edit_refreshes_cached_cards(self):
+        """Cached message cards pick up a new username after a profile edit."""
+        db.session.add(Message(text="cached card", user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+            self.assertIn('@testuser</a>', html)
+            self.assertEqual(fragments.stats()["entries"], 1)
+
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "image_url": "/static/images/default-pic.png",
+                "header_image_url": "/static/images/warbler-hero.jpg",
+                "bio": "",
+                "password": "testuser",
+            })
+
+            html = c.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+            self.assertIn('@renamed</a>', html)
+            self.assertNotIn('@testuser</a>', html)
+
+    def test_profile_revalidates(self):
+        """The profile page's ETag changes when the user posts."""
+        with self.client as c:
+            resp = c.get(f"/users/{self.u1_id}")
+            etag = resp.headers["ETag"]
+            resp = c.get(f"/users/{self.u1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            db.session.add(Message(text="news", user_id=self.u1_id))
+            User.bump([self.u1_id], messages_count=1)
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.u1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("news", resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            self.assertEqual(c.get("/users/1").status_code, 404)
+            self.assertEqual(c.get("/signup").headers["Cache-Control"],
+                             "no-store")
+
+    def test_users_search_ranks_prefix_first(self):
+        """Usernames starting with the search come before ones that only
+        contain it."""
+        with self.client as c:
+            html = c.get("/users?q=USER").get_data(as_text=True)
+            found = re.findall(r"<p>@(\w+)</p>", html)
+            self.assertEqual(found,
+                             ["user1", "user2", "user3", "user4", "testuser"])
+
+            html = c.get("/users?q=er3").get_data(as_text=True)
+            self.assertEqual(re.findall(r"<p>@(\w+)</p>", html), ["user3"])
+
+            # LIKE wildcards are just characters
+            html = c.get("/users?q=%25").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_users_directory_pagination(self):
+        """Pages pick up after the last user of the one before."""
+        for query in [None, "user", "ser"]:
+            seen = []
+            page = directory.page(query, None, 2)
+            while True:
+                seen.extend(user.username for user in page.items)
+                if not page.next_cursor:
+                    break
+                page = directory.page(query, decode_cursor(page.next_cursor), 2)
+
+            expected = (["testuser", "user1", "user2", "user3", "user4"]
+                        if query != "user" else
+                        ["user1", "user2", "user3", "user4", "testuser"])
+            self.assertEqual(seen, expected, query)
+
+        with self.client as c:
+            self.assertEqual(c.get("/users?after=???").status_code, 400)
+
+    def test_users_search_follows_renames(self):
+        """Signups, renames and deletions show up in search."""
+        with self.client as c:
+            c.get("/users?q=user")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/users/profile", data={
+                "username": "zebra",
+                "email": "test@test.com",
+                "image_url": "/static/images/default-pic.png",
+                "header_image_url": "/static/images/warbler-hero.jpg",
+                "bio": "",
+                "password": "testuser",
+            })
+            html = c.get("/users?q=ebr").get_data(as_text=True)
+            self.assertIn("<p>@zebra</p>", html)
+            html = c.get("/users?q=testuser").get_data(as_text=True)
+            self.assertNotIn("<p>@testuser</p>", html)
+
+            c.post("/users/delete")
+            html = c.get("/users?q=ebr").get_data(as_text=True)
+            self.assertNotIn("<p>@zebra</p>", html)
+
+    def test_users_typeahead(self):
+        """Typeahead finds usernames by prefix, and keeps up with renames."""
+        with self.client as c:
+            resp = c.get("/users/typeahead?q=US&limit=3")
+            self.assertEqual(resp.json["users"], [
+                {"id": self.u1_id, "username": "user1"},
+                {"id": self.u2_id, "username": "user2"},
+                {"id": self.u3_id, "username": "user3"},
+            ])
+            self.assertEqual(c.get("/users/typeahead?q=").json["users"], [])
+            self.assertEqual(c.get("/users/typeahead?q=x").json["users"], [])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/users/profile", data={
+                "username": "user0",
+                "email": "test@test.com",
+                "image_url": "/static/images/default-pic.png",
+                "header_image_url": "/static/images/warbler-hero.jpg",
+                "bio": "",
+                "password": "testuser",
+            })
+            resp = c.get("/users/typeahead?q=user&limit=1")
+            self.assertEqual(resp.json["users"],
+                             [{"id": self.testuser_id, "username": "user0"}])
+            self.assertEqual(c.get("/users/typeahead?q=test").json["users"],
+                             [])
+
+    def test_typeahead_sees_changes_from_other_workers(self):
+        """Once it's old, the typeahead index is rebuilt from the
+        database, in the background."""
+        prefixes = directory.prefixes
+        self.assertEqual(len(self.client.get("/users/typeahead?q=user")
+                             .json["users"]), 4)
+
+        # made through some other worker
+        db.session.add(User(username="user5", email="user5@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.get(User, self.u1_id).username = "renamed"
+        db.session.delete(db.session.get(User, self.u2_id))
+        db.session.commit()
+
+        prefixes.max_age = 0
+        try:
+            # the request that finds it stale is answered from the old copy
+            self.assertEqual(len(self.client.get("/users/typeahead?q=user")
+                                 .json["users"]), 4)
+            prefixes.rebuilding.join()
+        finally:
+            prefixes.max_age = 60
+
+        resp = self.client.get("/users/typeahead?q=user")
+        self.assertEqual([user["username"] for user in resp.json["users"]],
+                         ["user3", "user4", "user5"])
+        self.assertIsNone(prefixes.rebuilding)
+
+    def test_signup_sees_names_from_other_workers(self):
+        """A name this worker's filter hasn't seen is still caught at
+        signup, before the password is hashed."""
+        missed = directory.taken.stats()["missed"]
+        self.assertTrue(self.client.get(
+            "/users/available?username=elsewhere").json["username"])
+
+        # signed up through some other worker
+        db.session.add(User(username="elsewhere", email="else@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        hashes = password_pool.stats()["hash"]
+        resp = self.client.post("/signup", data={"username": "elsewhere",
+                                                 "email": "new@test.com",
+                                                 "password": "password"})
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+        self.assertEqual(password_pool.stats()["hash"], hashes)
+        self.assertEqual(directory.taken.stats()["missed"], missed + 1)
+
+    def test_available_sees_names_from_other_workers(self):
+        """Once it's old, the taken-names filter is rebuilt in the
+        background, not in the request that finds it stale."""
+        taken = directory.taken
+        self.assertTrue(self.client.get(
+            "/users/available?username=elsewhere").json["username"])
+
+        # signed up through some other worker
+        db.session.add(User(username="elsewhere", email="else@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        taken.max_age = 0
+        try:
+            self.assertTrue(self.client.get(
+                "/users/available?username=elsewhere").json["username"])
+            taken.rebuilding.join()
+        finally:
+            taken.max_age = 60
+
+        self.assertFalse(self.client.get(
+            "/users/available?username=elsewhere").json["username"])
+
+    def test_users_available_rate_limited(self):
+        """Availability checks are limited per address."""
+        for _ in range(30):
+            resp = self.client.get("/users/available?username=someone")
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get("/users/available?username=someone")
+        self.assertEqual(resp.status_code, 429)
+
+    def test_rate_limits_use_forwarded_address(self):
+        """Behind the proxy, each client has its own per-address limit."""
+        proxied = {"REMOTE_ADDR": "10.0.0.1"}
+        for _ in range(30):
+            resp = self.client.get(
+                "/users/available?username=someone", environ_base=proxied,
+                headers={"X-Forwarded-For": "203.0.113.1"})
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(
+            "/users/available?username=someone", environ_base=proxied,
+            headers={"X-Forwarded-For": "203.0.113.1"})
+        self.assertEqual(resp.status_code, 429)
+
+        # another client, through the same proxy
+        resp = self.client.get(
+            "/users/available?username=someone", environ_base=proxied,
+            headers={"X-Forwarded-For": "203.0.113.2"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_local_only(self):
+        """/_metrics isn't served to clients relayed by the proxy."""
+        self.assertEqual(self.client.get("/_metrics").status_code, 200)
+        resp = self.client.get("/_metrics",
+                               headers={"X-Forwarded-For": "203.0.113.1"})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_signup_taken_name_skips_hashing(self):
+        """A taken username is turned away before the password is hashed."""
+        with self.client as c:
+            hashes = password_pool.stats()["hash"]
+            before = directory.taken.stats()
+            resp = c.post("/signup", data={"username": "user1",
+                                           "email": "new@test.com",
+                                           "password": "password"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username already taken", resp.get_data(as_text=True))
+            self.assertEqual(password_pool.stats()["hash"], hashes)
+
+            self.assertEqual(
+                c.get("/users/available?username=user1&email=new@test.com")
+                .json, {"username": False, "email": True})
+
+            # /users/available answers free names without a query; signup
+            # confirms them
+            stats = directory.taken.stats()
+            self.assertEqual(stats["checks"] - before["checks"], 4)
+            self.assertEqual(stats["queries"] - before["queries"], 3)
+
+            resp = c.post("/signup", data={"username": "newbie",
+                                           "email": "new@test.com",
+                                           "password": "password"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(c.get("/users/available?username=newbie").json,
+                             {"username": False})
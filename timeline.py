@@ -0,0 +1,478 @@
+"""Precomputed home timelines for Warbler.
+
+Each logged-in user's home feed is kept as a bounded list of
+(timestamp, message_id) entries. When a message is posted its id is pushed
+into the timelines of the author's followers ("fan-out on write"), so the
+homepage reads a short, already-sorted list instead of querying every
+followed account.
+
+Timelines are a cache of the database, not the source of truth: a timeline
+that isn't in the store is rebuilt from the database the next time it's read.
+"""
+
+import bisect
+import heapq
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from feed import feed_items, feed_query
+from models import db, User, Message, Follows
+from pagination import Page, make_page, older_than
+
+# How many entries we keep per user. The homepage shows the first 100.
+TIMELINE_LENGTH = 800
+
+# Accounts with more followers than this are pulled at read time instead of
+# being pushed to every follower.
+PULL_THRESHOLD = 10000
+
+
+class MemoryTimelineStore:
+    """Timelines kept in a dict inside this worker process.
+
+    Each timeline is a list of (timestamp, message_id) sorted oldest first,
+    so new messages are appended (or bisected) in near-constant time and the
+    oldest entries are trimmed from the front.
+
+    Posts are only pushed into the timelines of the worker that handled
+    them, so with several workers the others' copies go stale. A timeline
+    is therefore rebuilt once it's `ttl` seconds old, and at most
+    `max_users` are kept, least recently read dropped first.
+    """
+
+    def __init__(self, max_length=TIMELINE_LENGTH, ttl=60, max_users=10000):
+        self.max_length = max_length
+        self.ttl = ttl
+        self.max_users = max_users
+        # user_id -> (built at, entries), least recently used first
+        self._timelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entries(self, user_id):
+        """The user's live timeline, or None; marks it recently used."""
+
+        timeline = self._timelines.get(user_id)
+        if timeline is None:
+            return None
+        built, entries = timeline
+        if time.monotonic() - built > self.ttl:
+            del self._timelines[user_id]
+            return None
+        self._timelines.move_to_end(user_id)
+        return entries
+
+    def get(self, user_id, limit, before=None):
+        """Return newest-first entries for user, or None if not built yet
+        (or expired).
+
+        If `before` is given, only entries older than it are returned.
+        """
+
+        with self._lock:
+            entries = self._entries(user_id)
+            if entries is None:
+                return None
+            end = bisect.bisect_left(entries, before) if before else len(entries)
+            return entries[max(end - limit, 0):end][::-1]
+
+    def put(self, user_id, entries):
+        """Store a freshly built timeline (entries may be in any order)."""
+
+        entries = sorted(entries)[-self.max_length:]
+        with self._lock:
+            self._timelines.pop(user_id, None)
+            self._timelines[user_id] = (time.monotonic(), entries)
+            while len(self._timelines) > self.max_users:
+                self._timelines.popitem(last=False)
+
+    def push(self, user_ids, timestamp, message_id):
+        """Add a message to the timelines of these users.
+
+        Users whose timeline isn't built are skipped; the message will be
+        picked up when their timeline is rebuilt from the database.
+        """
+
+        entry = (timestamp, message_id)
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is None:
+                    continue
+                entries = timeline[1]
+                bisect.insort(entries, entry)
+                if len(entries) > self.max_length:
+                    del entries[0]
+
+    def remove(self, user_ids, message_id):
+        """Remove a message from the timelines of these users."""
+
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline:
+                    timeline[1][:] = [e for e in timeline[1]
+                                      if e[1] != message_id]
+
+    def drop(self, user_ids):
+        """Forget these users' timelines; they'll be rebuilt on next read."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._timelines.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+
+
+def _iso(timestamp):
+    """Fixed-width ISO string, so text order matches time order."""
+
+    return timestamp.isoformat(timespec="microseconds")
+
+
+class SQLiteTimelineStore:
+    """Timelines kept in a local SQLite file.
+
+    Useful as a stand-in for a shared timeline service: every gunicorn
+    worker on the host sees the same timelines. Use ":memory:" for a
+    throwaway store in tests.
+    """
+
+    def __init__(self, path, max_length=TIMELINE_LENGTH):
+        self.max_length = max_length
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS timelines (
+                user_id INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS timeline_entries (
+                user_id INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, timestamp, message_id)
+            ) WITHOUT ROWID;
+        """)
+
+    def get(self, user_id, limit, before=None):
+        before = (_iso(before[0]), before[1]) if before else ("~", 0)
+        with self._lock:
+            built = self._conn.execute(
+                "SELECT 1 FROM timelines WHERE user_id = ?",
+                (user_id,)).fetchone()
+            if not built:
+                return None
+            rows = self._conn.execute(
+                """SELECT timestamp, message_id FROM timeline_entries
+                   WHERE user_id = ? AND (timestamp, message_id) < (?, ?)
+                   ORDER BY timestamp DESC, message_id DESC
+                   LIMIT ?""",
+                (user_id, *before, limit)).fetchall()
+        return [(datetime.fromisoformat(ts), mid) for ts, mid in rows]
+
+    def put(self, user_id, entries):
+        entries = sorted(entries)[-self.max_length:]
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "DELETE FROM timeline_entries WHERE user_id = ?", (user_id,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO timeline_entries VALUES (?, ?, ?)",
+                [(user_id, _iso(ts), mid) for ts, mid in entries])
+            self._conn.execute(
+                "INSERT OR IGNORE INTO timelines VALUES (?)", (user_id,))
+
+    def push(self, user_ids, timestamp, message_id):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        marks = ",".join("?" * len(user_ids))
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                f"""INSERT OR IGNORE INTO timeline_entries
+                    SELECT user_id, ?, ? FROM timelines
+                    WHERE user_id IN ({marks})""",
+                [_iso(timestamp), message_id, *user_ids])
+            # trim anything that fell off the end of each timeline
+            self._conn.execute(
+                f"""DELETE FROM timeline_entries
+                    WHERE user_id IN ({marks})
+                      AND (user_id, timestamp, message_id) IN (
+                        SELECT user_id, timestamp, message_id FROM (
+                          SELECT user_id, timestamp, message_id,
+                                 ROW_NUMBER() OVER (
+                                   PARTITION BY user_id
+                                   ORDER BY timestamp DESC, message_id DESC
+                                 ) AS n
+                          FROM timeline_entries
+                          WHERE user_id IN ({marks})
+                        ) WHERE n > ?)""",
+                [*user_ids, *user_ids, self.max_length])
+
+    def remove(self, user_ids, message_id):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        marks = ",".join("?" * len(user_ids))
+        with self._lock:
+            self._conn.execute(
+                f"""DELETE FROM timeline_entries
+                    WHERE message_id = ? AND user_id IN ({marks})""",
+                [message_id, *user_ids])
+
+    def drop(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        marks = ",".join("?" * len(user_ids))
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                f"DELETE FROM timelines WHERE user_id IN ({marks})", user_ids)
+            self._conn.execute(
+                f"DELETE FROM timeline_entries WHERE user_id IN ({marks})",
+                user_ids)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM timelines")
+            self._conn.execute("DELETE FROM timeline_entries")
+
+
+def create_timeline_store(uri, ttl=60, max_users=10000):
+    """Make a timeline store from a URI.
+
+    - "memory://" keeps timelines in this process, for up to `ttl` seconds
+      and `max_users` users (fine for one worker; with several, each only
+      sees its own workers' posts until its copy expires)
+    - "sqlite:///path/to/file.db" (or "sqlite://" for in-memory SQLite),
+      which every worker on the host shares
+    """
+
+    if uri == "memory://":
+        return MemoryTimelineStore(ttl=ttl, max_users=max_users)
+
+    if uri.startswith("sqlite://"):
+        return SQLiteTimelineStore(uri[len("sqlite:///"):] or ":memory:")
+
+    raise ValueError(f"Unknown timeline store: {uri}")
+
+
+##############################################################################
+# Hybrid push/pull delivery
+#
+# Pushing every post into every follower's timeline gets expensive for
+# accounts with huge followings, so accounts with more than `pull_threshold`
+# followers aren't fanned out. Their messages are pulled at read time instead
+# and merged with the pushed timeline.
+
+
+_pulled_cache = {}
+_pulled_lock = threading.Lock()
+
+
+def pulled_authors(pull_threshold, ttl=60):
+    """Ids of accounts whose messages are pulled rather than pushed.
+
+    This is shared by every request in the worker, so it is cached for
+    `ttl` seconds.
+    """
+
+    now = time.monotonic()
+    with _pulled_lock:
+        cached = _pulled_cache.get(pull_threshold)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    authors = frozenset(
+        author_id for (author_id,) in (
+            db.session.query(User.id)
+            .filter(User.followers_count > pull_threshold)
+        )
+    )
+
+    with _pulled_lock:
+        _pulled_cache[pull_threshold] = (now + ttl, authors)
+    return authors
+
+
+def author_streams(author_ids, limit, before=None):
+    """Newest `limit` entries for each author, as newest-first lists.
+
+    This is one round trip: a UNION ALL of one small, index-backed query
+    per author.
+    """
+
+    if not author_ids:
+        return []
+
+    streams = {}
+    for author_id, timestamp, message_id in db.session.execute(
+            author_streams_query(author_ids, limit, before)):
+        streams.setdefault(author_id, []).append((timestamp, message_id))
+
+    return [sorted(entries, reverse=True) for entries in streams.values()]
+
+
+def author_streams_query(author_ids, limit, before=None):
+    """UNION ALL of one small, index-backed query per author."""
+
+    per_author = [
+        db.select(Message.user_id, Message.timestamp, Message.id)
+        .where(Message.user_id == author_id)
+        .where(older_than(before) if before else db.true())
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit)
+        .subquery()
+        for author_id in author_ids
+    ]
+    return db.union_all(*(db.select(sub) for sub in per_author))
+
+
+def merge_streams(streams, limit):
+    """Merge newest-first streams into the newest `limit` entries.
+
+    This is a k-way heap merge: only about `limit` entries are ever pulled
+    from the streams, instead of sorting their whole union. Messages that
+    show up in more than one stream (e.g. an account that recently crossed
+    the pull threshold) are only kept once.
+    """
+
+    merged = []
+    seen = set()
+    for entry in heapq.merge(*streams, reverse=True):
+        if entry[1] in seen:
+            continue
+        seen.add(entry[1])
+        merged.append(entry)
+        if len(merged) == limit:
+            break
+    return merged
+
+
+##############################################################################
+# Reading and writing timelines
+
+
+def follower_ids(user_id):
+    """Ids of everyone following this user."""
+
+    return [
+        follower_id for (follower_id,) in (
+            db.session.query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id)
+        )
+    ]
+
+
+def followed_ids(user_id, among):
+    """Which of the `among` ids this user follows."""
+
+    if not among:
+        return []
+
+    return [
+        followed_id for (followed_id,) in (
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(among))
+        )
+    ]
+
+
+def timeline_query(user_id, pulled=frozenset(), limit=TIMELINE_LENGTH,
+                   before=None):
+    """Query for the newest pushed entries of this user's timeline
+    (everything except messages from `pulled` authors)."""
+
+    followed = (db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))
+    if pulled:
+        followed = followed.filter(
+            Follows.user_being_followed_id.notin_(pulled))
+
+    query = (db.session.query(Message.timestamp, Message.id)
+             .filter(db.or_(Message.user_id == user_id,
+                            Message.user_id.in_(followed))))
+    if before:
+        query = query.filter(older_than(before))
+
+    return query.order_by(Message.timestamp.desc(),
+                          Message.id.desc()).limit(limit)
+
+
+def build_timeline(user_id, pulled=frozenset(), limit=TIMELINE_LENGTH,
+                   before=None):
+    """Pull the newest pushed entries for this user's timeline from the
+    database."""
+
+    return [tuple(entry)
+            for entry in timeline_query(user_id, pulled, limit, before)]
+
+
+def home_timeline(store, user_id, limit=100, pull_threshold=PULL_THRESHOLD,
+                  before=None):
+    """Get a page of this user's home feed (as FeedItems), newest first.
+
+    The pushed timeline comes from the store; messages from followed
+    high-follower accounts are pulled and merged in. Returns a Page whose
+    next_cursor (if any) continues the feed from where this page stops.
+    """
+
+    pulled = pulled_authors(pull_threshold)
+    wanted = limit + 1
+
+    entries = store.get(user_id, wanted, before)
+    if entries is None:
+        entries = build_timeline(user_id, pulled)
+        store.put(user_id, entries)
+        entries = [e for e in entries if not before or e < before][:wanted]
+
+    if before and len(entries) < wanted:
+        # may have scrolled past the end of the stored timeline: keep going
+        # from the database with the same keyset query the store replaces
+        entries = build_timeline(user_id, pulled, wanted, before)
+
+    pulled_followed = followed_ids(user_id, pulled - {user_id})
+    if pulled_followed:
+        entries = merge_streams(
+            [entries] + author_streams(pulled_followed, wanted, before),
+            wanted)
+
+    page = make_page(entries, limit, key=lambda entry: entry)
+    ids = [message_id for _, message_id in page.items]
+    if not ids:
+        return Page([], None)
+
+    found = {item.id: item for item in
+             feed_items(feed_query().filter(Message.id.in_(ids)))}
+    items = [found[message_id] for message_id in ids if message_id in found]
+    return Page(items, page.next_cursor)
+
+
+def fan_out(store, message, pull_threshold=PULL_THRESHOLD):
+    """Push a newly committed message to its author's and followers' feeds.
+
+    High-follower accounts only push to their own timeline; their followers
+    pull the message when they read their feed.
+    """
+
+    audience = [message.user_id]
+    if message.user_id not in pulled_authors(pull_threshold):
+        audience += follower_ids(message.user_id)
+    store.push(audience, message.timestamp, message.id)
+
+
+def retract(store, message):
+    """Remove a deleted message from every feed it was pushed to."""
+
+    audience = follower_ids(message.user_id) + [message.user_id]
+    store.remove(audience, message.id)